@@ -0,0 +1,105 @@
+"""Compare the 400-word splitter with the SigLIP token-window chunker on ingest speed and recall.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.chunking [path/to/file.pdf] [--queries 200] [--k 5]
+
+For each chunker the document is chunked and every chunk is encoded with SigLIP.
+The script reports chunks produced, how many stored tokens the text tower actually
+sees (the rest is truncated away), and end-to-end words/second. Recall@k uses
+sentences drawn from the document as queries: a query is a hit when one of the
+top-k chunks by vector search contains it (or half of it, when it straddles
+two chunks). Without a path, generated prose is used.
+"""
+from models.embedding_model import load_siglip_model, encode_with_siglip
+from models.ingestion import paragraphs_of
+from utils.text_utils import TextChunker, TokenChunker, extract_document, text_window, CHUNK_OVERLAP_TOKENS
+import argparse
+import asyncio
+import random
+import re
+import time
+import numpy as np
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+def sample_paragraphs(count: int = 300, seed: int = 0):
+    rng = random.Random(seed)
+    subjects = ["The controller", "Each node", "The backup job", "A certificate", "The proxy", "The scheduler",
+                "Firmware", "The license server", "Every cluster", "The log collector"]
+    verbs = ["rotates", "validates", "restarts", "encrypts", "replicates", "throttles", "archives", "monitors"]
+    objects = ["disk snapshots", "network routes", "user sessions", "audit logs", "cache entries",
+               "database indexes", "report schedules", "driver updates", "timeout policies"]
+    paragraphs = []
+    for i in range(count):
+        sentences = [
+            f"{rng.choice(subjects)} {rng.choice(verbs)} {rng.choice(objects)} every {rng.randint(2, 90)} minutes "
+            f"unless {rng.choice(objects)} are {rng.choice(['locked', 'stale', 'missing', 'pending'])}."
+            for _ in range(rng.randint(2, 6))
+        ]
+        paragraphs.append((1 + i // 6, " ".join(sentences)))
+    return paragraphs
+
+def contains(chunk: str, query: str) -> bool:
+    """Whether ``chunk`` holds the query sentence, or at least half of it when a chunk boundary splits it."""
+    words = query.split()
+    half = len(words) // 2
+    return query in chunk or ' '.join(words[:half + 1]) in chunk or ' '.join(words[half:]) in chunk
+
+def chunk_all(chunker, paragraphs):
+    chunks = []
+    for page_num, paragraph in paragraphs:
+        chunks.extend(chunker.add(page_num, paragraph))
+    chunks.extend(chunker.flush())
+    return [text for text, _ in chunks]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf", nargs="?")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.pdf:
+        page_texts, _ = extract_document(args.pdf, "bench", "bench")
+        paragraphs = list(paragraphs_of(page_texts))
+    else:
+        paragraphs = sample_paragraphs()
+    model, processor = asyncio.run(load_siglip_model())
+    tokenizer = processor.tokenizer
+    window = text_window(tokenizer)
+    words = sum(len(paragraph.split()) for _, paragraph in paragraphs)
+
+    rng = random.Random(1)
+    sentences = [s for _, paragraph in paragraphs for s in SENTENCE_PATTERN.split(paragraph) if len(s.split()) >= 5]
+    queries = rng.sample(sentences, min(args.queries, len(sentences)))
+    query_embeddings = encode_with_siglip(model, processor, texts=queries)
+    query_embeddings /= np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+
+    print(f"{words} words in {len(paragraphs)} paragraphs, text window {window} tokens, {len(queries)} queries")
+    print(f"{'chunker':<22}{'chunks':>8}{'tokens':>9}{'embedded':>10}{'chunk s':>9}{'encode s':>10}"
+          f"{'words/s':>9}{'recall@k':>10}")
+    chunkers = [
+        ("words 400/100", TextChunker(max_words=400, overlap_words=100)),
+        (f"tokens {window}/{CHUNK_OVERLAP_TOKENS}", TokenChunker(tokenizer, window, CHUNK_OVERLAP_TOKENS)),
+    ]
+    for name, chunker in chunkers:
+        started = time.perf_counter()
+        chunks = chunk_all(chunker, paragraphs)
+        chunk_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        embeddings = encode_with_siglip(model, processor, texts=chunks)
+        encode_seconds = time.perf_counter() - started
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        token_counts = [len(ids) for ids in tokenizer(chunks, add_special_tokens=False).input_ids]
+        embedded = sum(min(count, window) for count in token_counts)
+        top = np.argsort(-(query_embeddings @ embeddings.T), axis=1)[:, :args.k]
+        hits = sum(any(contains(chunks[i], query) for i in row) for query, row in zip(queries, top))
+        print(f"{name:<22}{len(chunks):>8}{sum(token_counts):>9}{embedded / sum(token_counts):>10.1%}"
+              f"{chunk_seconds:>9.2f}{encode_seconds:>10.1f}{words / (chunk_seconds + encode_seconds):>9.0f}"
+              f"{hits / len(queries):>10.3f}")
+
+if __name__ == "__main__":
+    main()
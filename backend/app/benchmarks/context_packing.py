@@ -0,0 +1,72 @@
+"""Measure prompt tokens and answer latency with and without context packing.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.context_packing [--text manual.txt] [--requests 16] [--budget 384]
+
+Chunks come from ``split_text_into_chunks`` over ``--text`` (or generated prose),
+so neighbouring chunks carry the chunker's usual overlap. Each request sends three
+adjacent chunks and a question taken from one of their sentences, one request at a
+time. "whole" sends the chunks unchanged, "dedup" only removes the overlap
+between them, "packed" also fits them into ``--budget`` tokens.
+"""
+from models.embedding_model import load_llm_model
+from models.context_packer import SENTENCE_PATTERN
+from models.generation import GenerationScheduler
+from utils.text_utils import split_text_into_chunks
+import argparse
+import asyncio
+import random
+import time
+
+def sample_paragraphs(seed: int = 0):
+    rng = random.Random(seed)
+    words = ("server restart driver log cache disk update backup node cluster firmware controller "
+             "policy license network timeout certificate proxy schedule report").split()
+    sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(6, 16))).capitalize() + "." for _ in range(600)]
+    return [(1 + i // 20, " ".join(sentences[i:i + 5])) for i in range(0, len(sentences), 5)]
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text", help="plain-text document to chunk; generated prose otherwise")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--budget", type=int, default=384)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.text:
+        with open(args.text) as f:
+            paragraphs = [(1, paragraph) for paragraph in f.read().split("\n\n") if paragraph.strip()]
+    else:
+        paragraphs = sample_paragraphs()
+    chunks = [chunk for chunk, _ in split_text_into_chunks(paragraphs)]
+    if len(chunks) < 3:
+        raise SystemExit("Need at least three chunks; use a longer --text")
+    rng = random.Random(1)
+    requests = []
+    for _ in range(args.requests):
+        start = rng.randrange(len(chunks) - 2)
+        context = [chunks[start + 1], chunks[start], chunks[start + 2]]
+        question = rng.choice(SENTENCE_PATTERN.split(context[0])).rstrip(".")
+        requests.append((f"What does the manual say about: {question}?", context))
+
+    model, tokenizer = await load_llm_model()
+    print(f"{len(requests)} sequential requests over {len(chunks)} chunks, budget {args.budget} tokens")
+    print(f"{'mode':<8}{'ctx tok in':>11}{'ctx tok out':>12}{'pack ms':>9}{'prompt tok':>11}{'prefill ms':>11}{'TTFT ms':>9}{'total s':>9}")
+    for mode, budget in (("whole", None), ("dedup", 0), ("packed", args.budget)):
+        scheduler = GenerationScheduler(model, tokenizer, max_batch_size=1, max_new_tokens=args.max_new_tokens,
+                                        context_budget=budget)
+        scheduler.start()
+        started = time.perf_counter()
+        for query, context in requests:
+            await scheduler.generate(query, context)
+        total = (time.perf_counter() - started) / len(requests)
+        stats = scheduler.stats()
+        await scheduler.stop()
+        print(f"{mode:<8}{stats['context_tokens_in'] / len(requests):>11.0f}"
+              f"{stats['context_tokens_out'] / len(requests):>12.0f}{stats['avg_packing_ms']:>9.1f}"
+              f"{(stats['prefill_tokens'] + stats['prefix_hits'] * stats['prefix_tokens']) / len(requests):>11.0f}"
+              f"{stats['prefill_ms'] / len(requests):>11.1f}{stats['avg_time_to_first_token_ms']:>9.1f}{total:>9.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Time PDF extraction and cleaning at several process-pool sizes.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.extraction [path/to/file.pdf] [--pages 200] [--workers 1 2 4 8]
+
+Without a path a synthetic PDF with ``--pages`` text pages is generated.
+"""
+from utils.text_utils import extract_document
+from utils import text_utils
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+import fitz
+
+LEGACY_PATTERNS = [
+    (r'\{[^{}]*\}|\<[^\<>]*\>', ' '),
+    (r'```[\s\S]*?```', ' '),
+    (r'`[^`]*`', ' '),
+    (r'\b\d+\.\d+\.\d+[\w.-]*\b', ' '),
+    (r'(\.?/)?[\w/-]+/[\w/-]+(\.[\w]+)?', ' '),
+    (r'[^\w\s.,!?]', ' '),
+    (r'[.,!?]{2,}', ' '),
+    (r'[ \t]+', ' '),
+    (r'(\n\s*)+\n', '\n\n'),
+]
+
+SAMPLE_LINE = (
+    "Release 2.4.1-beta moved config to ./etc/app/settings.yaml; see `run --fast` or {opts} <tag>... "
+    "The retrieval pipeline encodes every chunk, fuses dense and sparse ranks, and returns results!! "
+)
+
+def legacy_clean_text(text: str) -> str:
+    for pattern, replacement in LEGACY_PATTERNS:
+        text = re.sub(pattern, replacement, text)
+    return text.strip()
+
+def build_pdf(path: str, pages: int):
+    with fitz.open() as doc:
+        for page_num in range(pages):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 560, 800), f"Page {page_num + 1}\n" + SAMPLE_LINE * 12, fontsize=9)
+        doc.save(path)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf", nargs="?")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="extract-bench-")
+    pdf_path = args.pdf
+    if pdf_path is None:
+        pdf_path = os.path.join(workdir, "synthetic.pdf")
+        build_pdf(pdf_path, args.pages)
+    os.chdir(workdir)
+
+    with fitz.open(pdf_path) as doc:
+        raw_pages = [page.get_text("text") for page in doc]
+    start = time.perf_counter()
+    legacy = [legacy_clean_text(text) for text in raw_pages]
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    fused = [text_utils.clean_text(text) for text in raw_pages]
+    fused_seconds = time.perf_counter() - start
+    mismatches = sum(a != b for a, b in zip(legacy, fused))
+    print(f"clean_text over {len(raw_pages)} pages: legacy {legacy_seconds * 1000:.1f} ms, "
+          f"fused {fused_seconds * 1000:.1f} ms, mismatched pages {mismatches}")
+
+    text_utils.EXTRACT_PARALLEL_MIN_PAGES = 0
+    baseline = None
+    for workers in args.workers:
+        # Time a warm pool, as the server keeps one for its lifetime.
+        text_utils.EXTRACT_WORKERS = workers
+        extract_document(pdf_path, "bench", "bench", workers=workers)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            page_texts, _ = extract_document(pdf_path, "bench", "bench", workers=workers)
+            timings.append(time.perf_counter() - start)
+        text_utils.shutdown_process_pool()
+        if baseline is None:
+            baseline = page_texts
+        best = min(timings)
+        print(f"workers={workers}: best {best:.3f}s ({len(page_texts) / best:.0f} pages/s), "
+              f"same output as workers={args.workers[0]}: {page_texts == baseline}")
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Compare answer-generation throughput of one-at-a-time decoding with the batching scheduler.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.generation [--requests 32] [--concurrency 8] [--max-batch-size 8]
+
+Both runs answer the same synthetic questions with the same concurrency and the
+same ``GEN_*`` sampling settings; the baseline is the scheduler limited to a batch
+of one, so requests decode one after another, the second run merges them into one
+running batch.
+"""
+from models.embedding_model import load_llm_model
+from models.generation import GenerationScheduler
+import argparse
+import asyncio
+import time
+
+CONTEXT = (
+    "Run the installer with administrator rights, then restart the service. "
+    "Logs are written to /var/log/app and rotated daily. "
+    "Upgrades from version 2.x require a database backup first."
+)
+
+def questions(n: int):
+    topics = ["installer", "logs", "upgrade", "restart", "backup", "rotation", "permissions", "service"]
+    return [f"What should I know about the {topics[i % len(topics)]} (case {i})?" for i in range(n)]
+
+async def run_all(answer, queries, concurrency: int):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(query):
+        async with limit:
+            started = time.perf_counter()
+            await answer(query)
+            return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[one(query) for query in queries])
+    return time.perf_counter() - started, sorted(latencies)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    model, tokenizer = await load_llm_model()
+    queries = questions(args.requests)
+    print(f"{args.requests} requests, concurrency {args.concurrency}")
+    print(f"{'mode':<12}{'wall s':>9}{'req/s':>9}{'p50 s':>9}{'p95 s':>9}{'tok/s':>9}{'occupancy':>11}")
+
+    for mode, max_batch_size in (("per-request", 1), ("scheduler", args.max_batch_size)):
+        scheduler = GenerationScheduler(model, tokenizer, max_batch_size=max_batch_size)
+        scheduler.start()
+        wall, latencies = await run_all(lambda query: scheduler.generate(query, [CONTEXT]), queries, args.concurrency)
+        stats = scheduler.stats()
+        await scheduler.stop()
+        print(f"{mode:<12}{wall:>9.1f}{len(queries) / wall:>9.2f}"
+              f"{latencies[len(latencies) // 2]:>9.2f}{latencies[int(len(latencies) * 0.95)]:>9.2f}"
+              f"{stats['tokens_per_second']:>9.1f}{stats['batch_occupancy']:>11.2f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
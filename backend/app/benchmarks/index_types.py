@@ -0,0 +1,111 @@
+"""Compare recall@k, latency and memory of index types against the exact Flat index.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.index_types [--chatwindow <uuid>] [--vectors 50000] [--queries 500]
+
+With ``--chatwindow`` the window's own segment vectors are used, and its vectors
+double as queries. Otherwise a clustered synthetic set of SigLIP-sized vectors is
+generated.
+"""
+from models.faiss_manager import get_vector_store, init_faiss, index_nbytes, train_index, rerank_exact
+from models.vector_store import VectorIdMap, VectorSegmentStore
+import argparse
+import os
+import tempfile
+import time
+import uuid
+import faiss
+import numpy as np
+
+FACTORIES = [
+    "Flat",
+    "HNSW32",
+    "HNSW32,SQ8",
+    "IVF{nlist},SQ8",
+    "IVF{nlist},PQ64",
+    "PCA256,IVF{nlist},SQ8",
+    "PCA256,HNSW32,SQ8",
+]
+
+def synthetic_vectors(n: int, dimension: int, clusters: int = 512, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype("float32")
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dimension)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def segment_for(vectors):
+    """Write ``vectors`` to a throwaway segment so re-ranking reads them from disk like the server does."""
+    store = VectorSegmentStore(tempfile.mkdtemp(prefix="index-bench-"), vectors.shape[1])
+    row_ids = [str(uuid.UUID(int=i + 1)) for i in range(len(vectors))]
+    _, rows, positions = store.append("bench", "text", row_ids, vectors)
+    return store, rows, positions
+
+def recall_at_k(truth, found, k):
+    return float(np.mean([len(set(t[:k]) & set(f[:k])) / k for t, f in zip(truth, found)]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chatwindow")
+    parser.add_argument("--vectors", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dimension", type=int, default=1152)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.chatwindow:
+        store = get_vector_store(args.chatwindow, args.dimension)
+        vectors, rows, positions = store.read()
+        queries = vectors[np.random.default_rng(1).choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+        queries = queries + 0.05 * np.random.default_rng(2).standard_normal(queries.shape).astype("float32")
+    else:
+        data = synthetic_vectors(args.vectors + args.queries, args.dimension)
+        vectors, queries = data[:args.vectors], data[args.vectors:]
+        store, rows, positions = segment_for(vectors)
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    faiss.normalize_L2(queries)
+    ids = np.ascontiguousarray(rows["vector_id"])
+    nlist = int(min(max(4 * np.sqrt(len(vectors)), 16), 65536))
+    print(f"{len(vectors)} vectors, {len(queries)} queries, k={args.k}")
+    print(f"{'index':<26}{'recall@k':>10}{'+rerank':>10}{'ms/query':>10}{'+rerank':>10}{'bytes/vec':>11}{'build s':>9}")
+
+    truth = None
+    for factory in FACTORIES:
+        factory = factory.format(nlist=nlist)
+        start = time.perf_counter()
+        index = init_faiss(args.dimension, len(vectors), factory=factory)
+        train_index(index, vectors)
+        index.add_with_ids(vectors, ids)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, found = index.search(queries, args.k)
+        search_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        if truth is None:
+            truth = found
+        recall = recall_at_k(truth, found, args.k)
+
+        all_ids = VectorIdMap(ids, rows["kind"], rows["row_id"], positions)
+        all_ids.store, all_ids.generation = store, store.generation()
+        start = time.perf_counter()
+        reranked = []
+        for query in queries:
+            query = query[None, :]
+            scores, shortlist = index.search(query, args.k * args.rerank_factor)
+            result = rerank_exact(all_ids, query, scores, shortlist, args.k)
+            reranked.append(result[1][0] if result is not None else shortlist[0][:args.k])
+        rerank_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        rerank_recall = recall_at_k(truth, reranked, args.k)
+
+        print(f"{factory:<26}{recall:>10.3f}{rerank_recall:>10.3f}{search_ms:>10.3f}{rerank_ms:>10.3f}"
+              f"{index_nbytes(index) / len(vectors):>11.0f}{build_seconds:>9.1f}")
+
+    if not args.chatwindow:
+        for name in os.listdir(store.directory):
+            os.remove(os.path.join(store.directory, name))
+        os.rmdir(store.directory)
+
+if __name__ == "__main__":
+    main()
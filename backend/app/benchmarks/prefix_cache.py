@@ -0,0 +1,48 @@
+"""Measure prefill time and time-to-first-token with and without the prompt prefix cache.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.prefix_cache [--requests 32] [--context-words 60] [--max-new-tokens 16]
+
+Requests are sent one at a time so prefill is not shared across a batch; each
+mode gets a fresh scheduler over the same loaded model.
+"""
+from models.embedding_model import load_llm_model
+from models.generation import GenerationScheduler
+from benchmarks.generation import questions, CONTEXT
+import argparse
+import asyncio
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--context-words", type=int, default=60)
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    args = parser.parse_args()
+
+    model, tokenizer = await load_llm_model()
+    words = (CONTEXT.split() * (args.context_words // len(CONTEXT.split()) + 1))[:args.context_words]
+    context = " ".join(words)
+    queries = questions(args.requests)
+    print(f"{args.requests} sequential requests, {args.context_words}-word context")
+    print(f"{'mode':<10}{'prefix tok':>11}{'prefill tok/req':>16}{'prefill ms/req':>15}{'TTFT ms':>9}")
+
+    for prefix_cache in (False, True):
+        scheduler = GenerationScheduler(
+            model, tokenizer, max_batch_size=1, max_new_tokens=args.max_new_tokens, prefix_cache=prefix_cache
+        )
+        scheduler.start()
+        await scheduler.generate("warm-up", [context])
+        warm = scheduler.stats()
+        for query in queries:
+            await scheduler.generate(query, [context])
+        stats = scheduler.stats()
+        await scheduler.stop()
+        prefill_tokens = (stats["prefill_tokens"] - warm["prefill_tokens"]) / len(queries)
+        prefill_ms = (stats["prefill_ms"] - warm["prefill_ms"]) / len(queries)
+        ttft_ms = (stats["avg_time_to_first_token_ms"] * (len(queries) + 1) - warm["avg_time_to_first_token_ms"]) / len(queries)
+        print(f"{'cached' if prefix_cache else 'full':<10}{stats['prefix_tokens']:>11}{prefill_tokens:>16.1f}"
+              f"{prefill_ms:>15.1f}{ttft_ms:>9.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
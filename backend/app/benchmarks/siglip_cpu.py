@@ -0,0 +1,87 @@
+"""Compare fp32, int8 dynamically quantized and text-tower-only SigLIP on CPU.
+
+Run from ``backend/app``::
+
+    python -m benchmarks.siglip_cpu [--model google/siglip-so400m-patch14-384] [--texts queries.txt]
+                                    [--threads 8] [--queries 256] [--k 10]
+
+Reports single-query latency (p50/p95), batched throughput, weight memory and how
+closely each variant's embeddings agree with fp32: mean/min cosine similarity and
+top-k overlap when the same texts are searched against each other.
+"""
+from models.embedding_model import configure_cpu_threads, encode_with_siglip, load_siglip_model, SIGLIP_MODEL_NAME
+import argparse
+import asyncio
+import io
+import time
+import numpy as np
+import torch
+
+VARIANTS = [
+    ("fp32", dict(quantize=False, text_only=False)),
+    ("int8", dict(quantize=True, text_only=False)),
+    ("text-only fp32", dict(quantize=False, text_only=True)),
+    ("text-only int8", dict(quantize=True, text_only=True)),
+]
+
+def sample_texts(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    words = ("install configure server driver firmware update error log network cache memory disk "
+             "version release upgrade backup restore cluster node policy license user password "
+             "timeout certificate proxy port database index query report schedule").split()
+    return [" ".join(rng.choice(words, rng.integers(4, 16))) for _ in range(n)]
+
+def weight_bytes(model) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def topk(embeddings, k):
+    scores = embeddings @ embeddings.T
+    return np.argsort(-scores, axis=1)[:, 1:k + 1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=SIGLIP_MODEL_NAME)
+    parser.add_argument("--texts", help="file with one query per line; synthetic queries otherwise")
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    configure_cpu_threads(args.threads)
+    if args.texts:
+        with open(args.texts) as f:
+            texts = [line.strip() for line in f if line.strip()][:args.queries]
+    else:
+        texts = sample_texts(args.queries)
+    print(f"{len(texts)} queries, {torch.get_num_threads()} intra-op threads, batch size {args.batch_size}")
+    print(f"{'variant':<16}{'p50 ms':>9}{'p95 ms':>9}{'q/s':>9}{'weights MB':>12}{'cos mean':>10}{'cos min':>9}{'top-k':>8}")
+
+    reference = reference_topk = None
+    for name, options in VARIANTS:
+        model, processor = asyncio.run(load_siglip_model(args.model, **options))
+        encode_with_siglip(model, processor, texts=texts[:1])
+
+        latencies = []
+        for text in texts[:64]:
+            start = time.perf_counter()
+            encode_with_siglip(model, processor, texts=[text])
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        embeddings = encode_with_siglip(model, processor, texts=texts, batch_size=args.batch_size)
+        throughput = len(texts) / (time.perf_counter() - start)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        if reference is None:
+            reference, reference_topk = embeddings, topk(embeddings, args.k)
+        cosines = np.sum(embeddings * reference, axis=1)
+        overlap = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(topk(embeddings, args.k), reference_topk)])
+        print(f"{name:<16}{np.percentile(latencies, 50):>9.1f}{np.percentile(latencies, 95):>9.1f}{throughput:>9.1f}"
+              f"{weight_bytes(model) / 1e6:>12.1f}{cosines.mean():>10.4f}{cosines.min():>9.4f}{overlap:>8.3f}")
+        del model
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,96 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 from models.embedding_model import *
-from models.faiss_manager import init_faiss
-from routes import pdf_routes, query_routes, window_routes
+from models.faiss_manager import create_index_cache
+from models.bm25_index import create_bm25_cache, ensure_nltk_data
+from models.answer_cache import AnswerCache
+from models.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_PATH
+from models.ingestion import IngestionQueue
+from models.query_batcher import QueryEmbeddingBatcher, create_query_cache
+from models.generation import LLMLoader, LLM_LOAD
+from utils.metrics import TimingMiddleware
+from utils.readiness import Readiness
+from utils.text_utils import shutdown_process_pool
+from routes import pdf_routes, query_routes, window_routes, stats_routes, health_routes
+from routes.health_routes import require_ready
 import asyncio
+import contextlib
+import logging
 import torch
 import uvicorn
-import nltk
 
-nltk.download('punkt_tab', quiet=True)
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    app.state.siglip_model, app.state.siglip_processor = await load_siglip_model()
-    app.state.llm_model, app.state.llm_tokenizer = await load_llm_model()
-    app.state.index = init_faiss(dimension=1152)
-    app.state.all_ids = []
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+async def load_siglip_and_warm_up():
+    model, processor = await load_siglip_model()
     loop = asyncio.get_event_loop()
-    batch_size = 64 if torch.cuda.is_available() else 8
     await loop.run_in_executor(
         None,
-        lambda: encode_with_siglip(
-            app.state.siglip_model,
-            app.state.siglip_processor,
-            texts=["Warm-up sentence"],
-            batch_size=batch_size
-        )
+        lambda: encode_with_siglip(model, processor, texts=["Warm-up sentence"])
     )
+    return model, processor
+
+async def load_components(app: FastAPI):
+    """Load models concurrently, then start the services that depend on them."""
+    readiness = app.state.readiness
+    loop = asyncio.get_event_loop()
+    if LLM_LOAD != "on_demand":
+        app.state.llm.start()
+    (app.state.siglip_model, app.state.siglip_processor), _ = await asyncio.gather(
+        readiness.track("siglip", load_siglip_and_warm_up()),
+        readiness.track("nltk", loop.run_in_executor(None, ensure_nltk_data)),
+    )
+    await readiness.track("services", start_services(app))
+
+async def start_services(app: FastAPI):
+    if EMBEDDING_CACHE_PATH:
+        app.state.embedding_cache = EmbeddingCache(embedding_model_id(app.state.siglip_model))
+    app.state.query_cache = create_query_cache()
+    app.state.query_batcher = QueryEmbeddingBatcher(
+        app.state.siglip_model, app.state.siglip_processor, cache=app.state.query_cache
+    )
+    app.state.query_batcher.start()
+    app.state.ingestion_queue = IngestionQueue(app)
+    app.state.ingestion_queue.start()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    required = ["siglip", "nltk", "services"] + (["llm"] if LLM_LOAD == "eager" else [])
+    app.state.readiness = Readiness(required)
+    app.state.llm = LLMLoader(app.state.readiness)
+    app.state.current_chatwindow = None
+    app.state.index_cache = create_index_cache()
+    app.state.bm25_cache = create_bm25_cache()
+    app.state.answer_cache = AnswerCache()
+    app.state.embedding_cache = None
+    app.state.query_cache = None
+    app.state.query_batcher = None
+    app.state.ingestion_queue = None
+
+    # The server accepts connections while models load; /health/ready reports progress
+    # and routes that need the models answer 503 until then.
+    startup = asyncio.create_task(load_components(app))
 
     yield
 
-    del app.state.siglip_model
-    del app.state.siglip_processor
-    del app.state.llm_model
-    del app.state.llm_tokenizer
+    startup.cancel()
+    with contextlib.suppress(BaseException):
+        await startup
+    if app.state.ingestion_queue is not None:
+        await app.state.ingestion_queue.stop()
+    if app.state.query_batcher is not None:
+        await app.state.query_batcher.stop()
+    await app.state.llm.unload()
+    app.state.answer_cache.close()
+    if app.state.embedding_cache is not None:
+        app.state.embedding_cache.close()
+    shutdown_process_pool()
+    for name in ("siglip_model", "siglip_processor"):
+        if hasattr(app.state, name):
+            delattr(app.state, name)
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
@@ -52,9 +106,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(pdf_routes.router, tags=["PDF"])
-app.include_router(query_routes.router, tags=["Query"])
+app.add_middleware(TimingMiddleware)
+
+app.include_router(pdf_routes.router, tags=["PDF"], dependencies=[Depends(require_ready)])
+app.include_router(query_routes.router, tags=["Query"], dependencies=[Depends(require_ready)])
 app.include_router(window_routes.router, tags=["Window"])
+app.include_router(stats_routes.router, tags=["Stats"])
+app.include_router(health_routes.router, tags=["Health"])
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
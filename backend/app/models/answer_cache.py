@@ -0,0 +1,69 @@
+from utils.lru_cache import LRUCache
+from utils.disk_cache import DiskCache
+from utils.text_utils import normalize_query
+import hashlib
+import json
+import os
+import threading
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "")
+ANSWER_CACHE_DISK_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_DISK_MAX_ENTRIES", "50000"))
+
+class AnswerCache:
+    """Cache of generated answers keyed on chatwindow version, query and context chunk ids.
+
+    The chatwindow version bumps on every upload and delete, so entries stop matching
+    exactly when the window's content changes. Entries are kept in memory and, when
+    ``disk_path`` is set, written through to a local SQLite file that survives restarts.
+    Safe to call from executor threads, which is where the routes do the disk I/O.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, disk_path: str = ANSWER_CACHE_PATH,
+                 disk_max_entries: int = ANSWER_CACHE_DISK_MAX_ENTRIES):
+        self.memory = LRUCache(max_entries=max_entries, sizeof=lambda answer: len(answer.encode()))
+        self.disk = DiskCache(disk_path, disk_max_entries) if disk_path else None
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(chatwindow_id: str, version: int, query: str, chunk_ids: list[str]) -> str:
+        payload = json.dumps([chatwindow_id, version, normalize_query(query), list(chunk_ids)])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            answer = self.memory.get(key)
+        if answer is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                answer = value.decode()
+                with self._lock:
+                    self.memory.put(key, answer)
+                    self.disk_hits += 1
+        return answer
+
+    def put(self, key: str, answer: str):
+        with self._lock:
+            self.memory.put(key, answer)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, answer.encode())
+            except Exception as e:
+                logger.warning(f"Failed to persist answer cache entry: {str(e)}")
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
@@ -0,0 +1,266 @@
+from collections import Counter, defaultdict
+from sqlalchemy.future import select
+from models.db_models import Document, TextChunk
+from models.vector_store import vector_id
+from utils.lru_cache import LRUCache
+from nltk.tokenize import word_tokenize
+import nltk
+import asyncio
+import json
+import math
+import os
+import threading
+import numpy as np
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_DIR = "data"
+BM25_DIR_NAME = "bm25"
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+BM25_CACHE_MAX_WINDOWS = int(os.getenv("BM25_CACHE_MAX_WINDOWS", "8"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Query terms found in more than this share of a window's chunks are left out of scoring,
+# once the window has at least BM25_MAX_DF_MIN_CHUNKS chunks.
+BM25_MAX_DF_RATIO = float(os.getenv("BM25_MAX_DF_RATIO", "0.5"))
+BM25_MAX_DF_MIN_CHUNKS = int(os.getenv("BM25_MAX_DF_MIN_CHUNKS", "1000"))
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own same she should so some such than that the
+their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours yourself yourselves
+""".split())
+
+def ensure_nltk_data():
+    """Download the punkt tokenizer tables unless they are already on disk."""
+    try:
+        nltk.data.find("tokenizers/punkt_tab")
+    except LookupError:
+        if not nltk.download("punkt_tab", quiet=True):
+            raise RuntimeError("NLTK punkt_tab data is missing and could not be downloaded")
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in word_tokenize(text.lower()) if any(c.isalnum() for c in token)]
+
+class BM25Index:
+    """Incremental Okapi BM25 inverted index over the text chunks of one chatwindow.
+
+    Postings map a term to ``{vector_id: term_frequency}``; chunks are keyed by the
+    same int64 ids as the FAISS index so sparse and dense hits can be fused directly.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)
+        self.doc_lengths = {}
+        self.total_length = 0
+        self.documents = {}
+        # Per-term ``(vector_ids, tfs, lengths)`` arrays, rebuilt after the term's postings change.
+        self._arrays = {}
+        # Searches run on executor threads while ingestion updates the index on the event loop.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def _add_chunks(self, vector_ids, term_counts, skip_known: bool):
+        added_ids, added_terms = [], []
+        for vid, counts in zip(vector_ids, term_counts):
+            if skip_known and vid in self.doc_lengths:
+                continue
+            for term, tf in counts.items():
+                self.postings[term][vid] = tf
+                self._arrays.pop(term, None)
+            length = sum(counts.values())
+            self.doc_lengths[vid] = length
+            self.total_length += length
+            added_ids.append(vid)
+            added_terms.append(list(counts))
+        return added_ids, added_terms
+
+    def add_document(self, doc_id: str, vector_ids: list[int], term_counts: list[dict]):
+        with self._lock:
+            self._remove_document(doc_id)
+            self.documents[doc_id] = self._add_chunks(vector_ids, term_counts, skip_known=False)
+
+    def extend_document(self, doc_id: str, vector_ids: list[int], term_counts: list[dict]):
+        """Add chunks to a document that is still being ingested, skipping ids already indexed."""
+        with self._lock:
+            doc_vector_ids, doc_terms = self.documents.setdefault(doc_id, ([], []))
+            added_ids, added_terms = self._add_chunks(vector_ids, term_counts, skip_known=True)
+            doc_vector_ids.extend(added_ids)
+            doc_terms.extend(added_terms)
+
+    def remove_document(self, doc_id: str):
+        with self._lock:
+            self._remove_document(doc_id)
+
+    def _remove_document(self, doc_id: str):
+        vector_ids, terms = self.documents.pop(doc_id, ([], []))
+        for vid, chunk_terms in zip(vector_ids, terms):
+            for term in chunk_terms:
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(vid, None)
+                    self._arrays.pop(term, None)
+                    if not postings:
+                        del self.postings[term]
+            self.total_length -= self.doc_lengths.pop(vid, 0)
+
+    def _term_arrays(self, term: str):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self.postings[term]
+            vector_ids = np.fromiter(postings.keys(), dtype="<i8", count=len(postings))
+            tfs = np.fromiter(postings.values(), dtype="float32", count=len(postings))
+            lengths = np.fromiter(map(self.doc_lengths.__getitem__, postings), dtype="float32", count=len(postings))
+            arrays = self._arrays[term] = (vector_ids, tfs, lengths)
+        return arrays
+
+    def query_terms(self, query_tokens: list[str]) -> list[str]:
+        """Distinct query terms worth scoring: no stopwords, and in large windows none that occur in most chunks.
+
+        In a window of ``BM25_MAX_DF_MIN_CHUNKS`` or more chunks, terms above
+        ``BM25_MAX_DF_RATIO`` add almost nothing to the ranking but cost a walk over
+        most of the window; when every term is that common, the rarest is kept. Small
+        windows score every term and leave common ones to the IDF.
+        """
+        terms = sorted({t for t in query_tokens if t not in STOPWORDS and t in self.postings},
+                       key=lambda t: len(self.postings[t]))
+        if len(self.doc_lengths) < BM25_MAX_DF_MIN_CHUNKS:
+            return terms
+        limit = BM25_MAX_DF_RATIO * len(self.doc_lengths)
+        return [t for t in terms if len(self.postings[t]) <= limit] or terms[:1]
+
+    def search(self, query_tokens: list[str], top_k: int = 10) -> list[tuple[int, float]]:
+        with self._lock:
+            n = len(self.doc_lengths)
+            if not n:
+                return []
+            avg_length = self.total_length / n
+            ids, contributions = [], []
+            for term in self.query_terms(query_tokens):
+                vector_ids, tfs, lengths = self._term_arrays(term)
+                idf = math.log((n - len(vector_ids) + 0.5) / (len(vector_ids) + 0.5) + 1)
+                norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+                ids.append(vector_ids)
+                contributions.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not ids:
+            return []
+        vector_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        top = np.argpartition(-scores, top_k - 1)[:top_k] if len(scores) > top_k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(vector_ids[i]), float(scores[i])) for i in top]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(postings) for postings in self.postings.values()) * 100 + len(self.doc_lengths) * 100
+
+def reciprocal_rank_fusion(rankings: list[list], k: int = RRF_K) -> dict:
+    """Fuse ranked id lists into ``{id: score}`` with score ``sum(1 / (k + rank))``."""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            fused[item_id] += 1.0 / (k + rank)
+    return fused
+
+def _bm25_dir(chatwindow_id: str) -> str:
+    return os.path.join(DATA_DIR, chatwindow_id, BM25_DIR_NAME)
+
+def build_document_postings(chunk_ids: list[str], texts: list[str]):
+    vector_ids = [vector_id(chunk_id) for chunk_id in chunk_ids]
+    term_counts = [dict(Counter(tokenize(text))) for text in texts]
+    return vector_ids, term_counts
+
+def save_document_postings(chatwindow_id: str, doc_id: str, vector_ids: list[int], term_counts: list[dict]):
+    directory = _bm25_dir(chatwindow_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{doc_id}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump({"vector_ids": vector_ids, "term_counts": term_counts}, f)
+    os.replace(path + ".tmp", path)
+
+def delete_document_postings(chatwindow_id: str, doc_id: str):
+    path = os.path.join(_bm25_dir(chatwindow_id), f"{doc_id}.json")
+    if os.path.exists(path):
+        os.remove(path)
+
+def load_bm25_index(chatwindow_id: str) -> BM25Index:
+    index = BM25Index()
+    directory = _bm25_dir(chatwindow_id)
+    if not os.path.isdir(directory):
+        return index
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            postings = json.load(f)
+        index.add_document(name[:-len(".json")], postings["vector_ids"], postings["term_counts"])
+    return index
+
+async def load_chatwindow_bm25(db, chatwindow_id: str) -> BM25Index:
+    loop = asyncio.get_event_loop()
+    index = await loop.run_in_executor(None, lambda: load_bm25_index(chatwindow_id))
+
+    documents = await db.execute(select(Document.id).filter(Document.chatwindow_id == chatwindow_id))
+    missing = [doc_id for doc_id in documents.scalars().all() if doc_id not in index.documents]
+    if missing:
+        logger.info(f"Building BM25 postings for {len(missing)} documents of chatwindow {chatwindow_id}")
+        chunks = await db.execute(
+            select(TextChunk.document_id, TextChunk.id, TextChunk.chunk)
+            .filter(TextChunk.document_id.in_(missing))
+            .order_by(TextChunk.document_id, TextChunk.chunk_index)
+        )
+        by_document = defaultdict(lambda: ([], []))
+        for doc_id, chunk_id, text in chunks.all():
+            by_document[doc_id][0].append(chunk_id)
+            by_document[doc_id][1].append(text)
+
+        def build_missing():
+            for doc_id, (chunk_ids, texts) in by_document.items():
+                vector_ids, term_counts = build_document_postings(chunk_ids, texts)
+                save_document_postings(chatwindow_id, doc_id, vector_ids, term_counts)
+                index.add_document(doc_id, vector_ids, term_counts)
+
+        await loop.run_in_executor(None, build_missing)
+    logger.info(f"Loaded BM25 index with {len(index)} chunks for chatwindow {chatwindow_id}")
+    return index
+
+def create_bm25_cache():
+    return LRUCache(max_entries=BM25_CACHE_MAX_WINDOWS, sizeof=lambda index: index.nbytes)
+
+async def get_chatwindow_bm25(cache, db, chatwindow_id: str) -> BM25Index:
+    index = cache.get(chatwindow_id)
+    if index is None:
+        index = await load_chatwindow_bm25(db, chatwindow_id)
+        cache.put(chatwindow_id, index)
+    return index
+
+async def add_chunks_to_bm25(cache, chatwindow_id: str, doc_id: str, chunk_ids: list[str], texts: list[str]):
+    """Index one batch of a document's chunks in the cached index; returns the postings for saving later.
+
+    The postings file is written once with ``save_document_postings`` when the whole
+    document is in. If the server stops before that, ``load_chatwindow_bm25`` rebuilds
+    the document from the chunks already in the database.
+    """
+    loop = asyncio.get_event_loop()
+    vector_ids, term_counts = await loop.run_in_executor(None, lambda: build_document_postings(chunk_ids, texts))
+    index = cache.peek(chatwindow_id)
+    if index is not None:
+        index.extend_document(doc_id, vector_ids, term_counts)
+        cache.put(chatwindow_id, index)
+    return vector_ids, term_counts
+
+def remove_document_from_bm25(cache, chatwindow_id: str, doc_id: str):
+    delete_document_postings(chatwindow_id, doc_id)
+    index = cache.peek(chatwindow_id)
+    if index is not None:
+        index.remove_document(doc_id)
+        cache.put(chatwindow_id, index)
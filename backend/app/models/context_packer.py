@@ -0,0 +1,137 @@
+from models.bm25_index import tokenize
+import math
+import os
+import re
+import time
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Token budget for the retrieved context in an answer prompt; 0 sends the retrieved chunks
+# as they are, only removing chunk overlap.
+LLM_CONTEXT_TOKEN_BUDGET = int(os.getenv("LLM_CONTEXT_TOKEN_BUDGET", "384"))
+# Most neighbouring chunks on each side of a retrieved chunk that widen_context may add.
+LLM_CONTEXT_RADIUS = int(os.getenv("LLM_CONTEXT_RADIUS", "4"))
+# Shortest run of words shared by two chunks that counts as chunker overlap rather than coincidence.
+MIN_OVERLAP_WORDS = 8
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+def _overlap(left: list[str], right: list[str]) -> int:
+    """Number of words at the end of ``left`` that ``right`` starts with."""
+    longest = min(len(left), len(right))
+    start = len(left) - longest
+    while start <= len(left) - MIN_OVERLAP_WORDS:
+        try:
+            start = left.index(right[0], start)
+        except ValueError:
+            return 0
+        if len(left) - start >= MIN_OVERLAP_WORDS and left[start:] == right[:len(left) - start]:
+            return len(left) - start
+        start += 1
+    return 0
+
+def drop_overlap(chunks: list[str]) -> list[str]:
+    """Remove the words a chunk repeats from a neighbouring chunk of the same document.
+
+    ``split_text_into_chunks`` carries the last ``overlap_words`` of each chunk into the
+    next one, so two adjacent chunks retrieved together would otherwise put that
+    stretch into the prompt twice. Retrieval order is not document order, so both
+    directions are checked against every chunk already kept.
+    """
+    kept = []
+    for chunk in chunks:
+        words = chunk.split()
+        for previous in kept:
+            head = _overlap(previous, words)
+            if head:
+                words = words[head:]
+            tail = _overlap(words, previous)
+            if tail:
+                words = words[:len(words) - tail]
+        if words:
+            kept.append(words)
+    return [' '.join(words) for words in kept]
+
+def widen_context(chunks: list, neighbours: dict, budget: int = LLM_CONTEXT_TOKEN_BUDGET) -> list[str]:
+    """Grow each retrieved chunk into a passage of its document until the context holds about ``budget`` words.
+
+    ``chunks`` are ``TextChunk`` rows in rank order and ``neighbours`` the texts around
+    them (see ``get_neighbouring_chunks``). Passages take turns adding their next,
+    then previous, chunk, best-ranked first, and stop at a chunk another passage
+    already holds. Words stand in for tokens, so the result slightly overshoots a
+    token budget and ``pack_context`` trims it with a choice of sentences. Chunks
+    sized for the SigLIP text window are far smaller than a prompt needs; chunks
+    that already fill the budget come back unchanged.
+    """
+    spans = [[chunk.chunk_index, chunk.chunk_index] for chunk in chunks]
+    taken = {(chunk.document_id, chunk.chunk_index) for chunk in chunks}
+    words = sum(len(chunk.chunk.split()) for chunk in chunks)
+    growing = True
+    while growing and words < budget:
+        growing = False
+        for chunk, span in zip(chunks, spans):
+            for side, step in ((1, 1), (0, -1)):
+                key = (chunk.document_id, span[side] + step)
+                if words >= budget or key in taken or key not in neighbours:
+                    continue
+                span[side] += step
+                taken.add(key)
+                words += len(neighbours[key].split())
+                growing = True
+    passages = []
+    for chunk, (start, end) in zip(chunks, spans):
+        texts = [chunk.chunk if i == chunk.chunk_index else neighbours[(chunk.document_id, i)] for i in range(start, end + 1)]
+        passages.append(' '.join(drop_overlap(texts)))
+    return passages
+
+def pack_context(tokenizer, query: str, chunks: list[str], budget: int = LLM_CONTEXT_TOKEN_BUDGET) -> tuple[list[str], dict]:
+    """Fit ``chunks`` into ``budget`` LLM tokens, keeping the sentences that best match ``query``.
+
+    Sentences are scored by the IDF-weighted query terms they contain (IDF taken over
+    the sentences of this context), ties going to higher-ranked chunks, and added
+    best-first while they fit. The survivors are put back in their original order
+    so each chunk still reads top to bottom. Returns the packed chunks and a report
+    of the token counts before (overlap included) and after.
+    """
+    started = time.perf_counter()
+    tokens_raw = sum(len(ids) for ids in tokenizer(chunks, add_special_tokens=False).input_ids) if chunks else 0
+    chunks = drop_overlap(chunks)
+    sentences = [
+        (rank, position, sentence)
+        for rank, chunk in enumerate(chunks)
+        for position, sentence in enumerate(SENTENCE_PATTERN.split(chunk))
+        if sentence
+    ]
+    if not sentences:
+        return chunks, {"tokens_in": tokens_raw, "tokens_out": 0, "ms": (time.perf_counter() - started) * 1000}
+    lengths = [len(ids) for ids in tokenizer([s for _, _, s in sentences], add_special_tokens=False).input_ids]
+    if not budget or sum(lengths) <= budget:
+        packed = chunks
+        tokens_out = sum(lengths)
+    else:
+        terms = [set(tokenize(sentence)) for _, _, sentence in sentences]
+        query_terms = set(tokenize(query))
+        frequency = {term: sum(term in sentence_terms for sentence_terms in terms) for term in query_terms}
+        idf = {term: math.log(1 + len(sentences) / count) for term, count in frequency.items() if count}
+        scores = [sum(idf.get(term, 0.0) for term in sentence_terms & query_terms) for sentence_terms in terms]
+        order = sorted(range(len(sentences)), key=lambda i: (-scores[i], sentences[i][0], sentences[i][1]))
+        selected = set()
+        tokens_out = 0
+        for i in order:
+            # The best sentence goes in even on its own over budget; an empty context helps nobody.
+            if tokens_out + lengths[i] <= budget or not selected:
+                selected.add(i)
+                tokens_out += lengths[i]
+        packed = []
+        for rank in range(len(chunks)):
+            kept = [sentence for i, (r, _, sentence) in enumerate(sentences) if r == rank and i in selected]
+            if kept:
+                packed.append(' '.join(kept))
+    report = {
+        "tokens_in": tokens_raw,
+        "tokens_out": tokens_out,
+        "ms": (time.perf_counter() - started) * 1000,
+    }
+    return packed, report
@@ -13,7 +13,22 @@ if not DATABASE_URL.startswith("postgresql+asyncpg"):
     raise ValueError(f"DATABASE_URL must use postgresql+asyncpg driver, got: {DATABASE_URL}")
 print(f"Loaded DATABASE_URL: {DATABASE_URL}")
 
-engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=DB_ECHO,
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True
+)
 
 AsyncSessionLocal = sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
@@ -23,4 +38,9 @@ Base = declarative_base()
 
 async def get_db():
     async with AsyncSessionLocal() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+async def run_in_session(func, *args):
+    """Run ``func(session, *args)`` on a fresh session so independent queries can be awaited concurrently."""
+    async with AsyncSessionLocal() as session:
+        return await func(session, *args)
\ No newline at end of file
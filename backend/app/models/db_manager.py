@@ -1,7 +1,9 @@
 from sqlalchemy.future import select
-from sqlalchemy import delete
+from sqlalchemy import and_, delete, insert, or_, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from models.db_models import ChatWindow, Document, TextChunk, ImageMetadata
+from collections import defaultdict
 import uuid
 
 async def create_chatwindow(db: AsyncSession, title: str):
@@ -65,26 +67,108 @@ async def delete_document(db: AsyncSession, chatwindow_id: str, doc_id: str):
         return True
     return False
 
-async def create_text_chunks(db: AsyncSession, document_id: str, chunks_with_pages: list[tuple[str, int]]):
-    for i, (chunk_text, page_number) in enumerate(chunks_with_pages):
-        chunk = TextChunk(
-            id=str(uuid.uuid4()),
-            document_id=document_id,
-            chunk=chunk_text,
-            chunk_index=i,
-            page_number=page_number
-        )
-        db.add(chunk)
+async def get_text_chunks_by_ids(db: AsyncSession, chunk_ids: list[str], chatwindow_id: str = None) -> dict:
+    """Chunks by id; with ``chatwindow_id``, only those whose document belongs to that window."""
+    if not chunk_ids:
+        return {}
+    query = select(TextChunk).filter(TextChunk.id.in_(chunk_ids)).options(selectinload(TextChunk.document))
+    if chatwindow_id is not None:
+        query = query.join(Document, TextChunk.document_id == Document.id).filter(Document.chatwindow_id == chatwindow_id)
+    result = await db.execute(query)
+    return {chunk.id: chunk for chunk in result.scalars().all()}
+
+async def get_neighbouring_chunks(db: AsyncSession, chunks: list, radius: int) -> dict:
+    """Text of the chunks up to ``radius`` positions around each of ``chunks`` in its document,
+    keyed by ``(document_id, chunk_index)``."""
+    if not chunks or radius <= 0:
+        return {}
+    result = await db.execute(
+        select(TextChunk.document_id, TextChunk.chunk_index, TextChunk.chunk).filter(or_(*[
+            and_(TextChunk.document_id == chunk.document_id,
+                 TextChunk.chunk_index.between(chunk.chunk_index - radius, chunk.chunk_index + radius))
+            for chunk in chunks
+        ]))
+    )
+    return {(document_id, chunk_index): text for document_id, chunk_index, text in result.all()}
+
+async def get_image_metadata_by_ids(db: AsyncSession, image_ids: list[str]) -> dict:
+    if not image_ids:
+        return {}
+    result = await db.execute(
+        select(ImageMetadata).filter(ImageMetadata.id.in_(image_ids)).options(selectinload(ImageMetadata.document))
+    )
+    return {image.id: image for image in result.scalars().all()}
+
+async def create_text_chunks(db: AsyncSession, document_id: str, chunks_with_pages: list[tuple[str, int]], offset: int = 0) -> list[str]:
+    rows = [
+        {
+            "id": str(uuid.uuid4()),
+            "document_id": document_id,
+            "chunk": chunk_text,
+            "chunk_index": i,
+            "page_number": page_number
+        }
+        for i, (chunk_text, page_number) in enumerate(chunks_with_pages, start=offset)
+    ]
+    if rows:
+        await db.execute(insert(TextChunk), rows)
+        await db.commit()
+    return [row["id"] for row in rows]
+
+def image_meta_data(img: dict) -> dict:
+    meta_data = {"page_number": img["page_number"]}
+    if "pages" in img:
+        meta_data["pages"] = list(img["pages"])
+    if "content_hash" in img:
+        meta_data["content_hash"] = img["content_hash"]
+    return meta_data
+
+async def create_image_metadata(db: AsyncSession, document_id: str, image_data: list[dict], offset: int) -> list[str]:
+    rows = [
+        {
+            "id": str(uuid.uuid4()),
+            "document_id": document_id,
+            "image_path": img["image_path"],
+            "embedding_id": offset + i,
+            "meta_data": image_meta_data(img)
+        }
+        for i, img in enumerate(image_data)
+    ]
+    if rows:
+        await db.execute(insert(ImageMetadata), rows)
+        await db.commit()
+    return [row["id"] for row in rows]
+
+async def update_image_pages(db: AsyncSession, images: dict):
+    """Rewrite ``meta_data`` of already stored images given ``{image_id: image record}``."""
+    await db.execute(
+        update(ImageMetadata),
+        [{"id": image_id, "meta_data": image_meta_data(img)} for image_id, img in images.items()]
+    )
     await db.commit()
 
-async def create_image_metadata(db: AsyncSession, document_id: str, image_data: list[dict], offset: int):
-    for i, img in enumerate(image_data):
-        image_metadata = ImageMetadata(
-            id=str(uuid.uuid4()),
-            document_id=document_id,
-            image_path=img["image_path"],
-            embedding_id=offset + i,
-            meta_data={"page_number": img["page_number"]}
-        )
-        db.add(image_metadata)
+async def get_chatwindow_row_ids(db: AsyncSession, chatwindow_id: str) -> tuple[dict, dict]:
+    """Load every chunk and image id of a window in two queries, as ``{doc_id: [row_id, ...]}`` in embedding order."""
+    chunks = await db.execute(
+        select(TextChunk.document_id, TextChunk.id)
+        .join(Document, TextChunk.document_id == Document.id)
+        .filter(Document.chatwindow_id == chatwindow_id)
+        .order_by(TextChunk.document_id, TextChunk.chunk_index)
+    )
+    images = await db.execute(
+        select(ImageMetadata.document_id, ImageMetadata.id)
+        .join(Document, ImageMetadata.document_id == Document.id)
+        .filter(Document.chatwindow_id == chatwindow_id)
+        .order_by(ImageMetadata.document_id, ImageMetadata.embedding_id)
+    )
+    chunk_ids = defaultdict(list)
+    for doc_id, chunk_id in chunks.all():
+        chunk_ids[doc_id].append(chunk_id)
+    image_ids = defaultdict(list)
+    for doc_id, image_id in images.all():
+        image_ids[doc_id].append(image_id)
+    return chunk_ids, image_ids
+
+async def set_document_image_embedding_path(db: AsyncSession, doc_id: str, image_embedding_path: str):
+    await db.execute(update(Document).where(Document.id == doc_id).values(image_embedding_path=image_embedding_path))
     await db.commit()
\ No newline at end of file
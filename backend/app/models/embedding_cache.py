@@ -0,0 +1,66 @@
+from utils.disk_cache import DiskCache
+import numpy as np
+import hashlib
+import os
+import unicodedata
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("data", "embedding_cache.sqlite"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "1000000"))
+
+class EmbeddingCache:
+    """Content-addressed store of SigLIP embeddings on local disk.
+
+    Keys hash the model id with the normalized chunk text or the raw image bytes, so
+    the same content reuses its vector across uploads, documents and chatwindows,
+    whatever the file is called. Vectors are stored as float32 bytes in a bounded
+    LRU ``DiskCache``.
+    """
+
+    def __init__(self, model_id: str, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.model_id = model_id
+        self.disk = DiskCache(path, max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, kind: str, content: bytes) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.model_id.encode())
+        digest.update(b"\0" + kind.encode() + b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def text_key(self, text: str) -> str:
+        return self._key("text", ' '.join(unicodedata.normalize('NFKC', text).split()).encode())
+
+    def image_key(self, content_hash: str) -> str:
+        """Key for an image given the sha256 of its bytes, as computed during extraction."""
+        return self._key("image", content_hash.encode())
+
+    def get_many(self, keys: list[str]) -> dict:
+        found = self.disk.get_many(list(set(keys)))
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return {key: np.frombuffer(value, dtype=np.float32) for key, value in found.items()}
+
+    def put_many(self, vectors: dict):
+        try:
+            self.disk.put_many({key: np.ascontiguousarray(vector, dtype=np.float32).tobytes() for key, vector in vectors.items()})
+        except Exception as e:
+            logger.warning(f"Failed to persist {len(vectors)} embeddings: {str(e)}")
+
+    def close(self):
+        self.disk.close()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "model_id": self.model_id,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "disk": self.disk.stats(),
+        }
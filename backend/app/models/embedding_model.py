@@ -1,28 +1,74 @@
 from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, AutoProcessor, AutoModel
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, AutoProcessor, AutoModel, SiglipTextModel
+from PIL import Image
+import numpy as np
 import asyncio
+import contextlib
+import os
 import torch
 from torch.amp.autocast_mode import autocast
 
-async def load_siglip_model(model_name="google/siglip-so400m-patch14-384"):
+SIGLIP_MODEL_NAME = os.getenv("SIGLIP_MODEL_NAME", "google/siglip-so400m-patch14-384")
+SIGLIP_BATCH_SIZE = int(os.getenv("SIGLIP_BATCH_SIZE", "64" if torch.cuda.is_available() else "8"))
+# CPU serving options: int8 dynamic quantization of nn.Linear layers, explicit torch
+# thread pools, and loading only the text tower on nodes that only embed queries.
+SIGLIP_CPU_INT8 = os.getenv("SIGLIP_CPU_INT8", "false").lower() in ("1", "true", "yes")
+SIGLIP_TEXT_ONLY = os.getenv("SIGLIP_TEXT_ONLY", "false").lower() in ("1", "true", "yes")
+SIGLIP_NUM_THREADS = int(os.getenv("SIGLIP_NUM_THREADS", "0"))
+SIGLIP_INTEROP_THREADS = int(os.getenv("SIGLIP_INTEROP_THREADS", "0"))
+LLM_CONTEXT_CHUNKS = int(os.getenv("LLM_CONTEXT_CHUNKS", "3"))
+LLM_MAX_PROMPT_TOKENS = 2048
+# Sampling settings the generation scheduler applies to every answer; the model's
+# generation config supplies the rest (for Qwen2-Instruct: do_sample, top_k=20, repetition_penalty=1.1).
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
+LLM_TOP_P = float(os.getenv("LLM_TOP_P", "0.7"))
+
+def is_quantized(model) -> bool:
+    return any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules())
+
+def embedding_model_id(model) -> str:
+    """Identifies what produced an embedding; cached vectors are only reused for the same id."""
+    return f"{model.name_or_path}:{model.dtype}" + (":int8" if is_quantized(model) else "")
+
+def configure_cpu_threads(num_threads: int = SIGLIP_NUM_THREADS, interop_threads: int = SIGLIP_INTEROP_THREADS):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only settable before the first parallel region has run.
+            pass
+
+def quantize_for_cpu(model):
+    """Int8 dynamic quantization of every ``nn.Linear``; activations stay float32."""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+async def load_siglip_model(model_name=SIGLIP_MODEL_NAME, quantize: bool = SIGLIP_CPU_INT8, text_only: bool = SIGLIP_TEXT_ONLY):
     try:
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         dtype = torch.float16 if device.type == 'cuda' else torch.float32
         loop = asyncio.get_event_loop()
+        if device.type == 'cpu':
+            configure_cpu_threads()
 
         processor = await loop.run_in_executor(
             None,
             lambda: AutoProcessor.from_pretrained(model_name)
         )
+        model_class = SiglipTextModel if text_only else AutoModel
         model = await loop.run_in_executor(
             None,
-            lambda: AutoModel.from_pretrained(
+            lambda: model_class.from_pretrained(
                 model_name,
                 torch_dtype=dtype,
                 device_map="auto"
             )
         )
         model.to(device)
+        model.eval()
+        if quantize and device.type == 'cpu':
+            model = await loop.run_in_executor(None, lambda: quantize_for_cpu(model))
         return model, processor
     except Exception as e:
         raise RuntimeError(f"Failed to load SigLIP model: {e}")
@@ -59,24 +105,57 @@ async def load_llm_model():
     except Exception as e:
         raise RuntimeError(f"Failed to load LLM model: {e}")
 
-def encode_with_siglip(model, processor, texts=None, images=None, batch_size=64):
+def _load_image(image):
+    if isinstance(image, (str, os.PathLike)):
+        with Image.open(image) as img:
+            return img.convert("RGB")
+    return image
+
+def iter_siglip_embeddings(model, processor, texts=None, images=None, batch_size=None):
+    """Encode ``texts`` or ``images`` ``batch_size`` items at a time, yielding ``(offset, embeddings)``.
+
+    Images may be PIL images or file paths; paths are decoded per batch so only one
+    batch of pixels is held in memory at a time. Texts are padded to the model's
+    fixed length so an embedding does not depend on what it was batched with.
+    """
+    items = texts if texts else images
+    if not items:
+        raise ValueError("Either texts or images must be provided")
+    text_only = isinstance(model, SiglipTextModel)
+    if images and text_only:
+        raise ValueError("Model was loaded with SIGLIP_TEXT_ONLY and cannot encode images")
+    batch_size = batch_size or SIGLIP_BATCH_SIZE
     device = next(model.parameters()).device
-    with autocast(device_type='cuda' if device.type == 'cuda' else 'cpu'):
-        if texts:
-            inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(device)
-            with torch.no_grad():
-                embeddings = model.get_text_features(**inputs).cpu().numpy()
-        elif images:
-            inputs = processor(images=images, return_tensors="pt").to(device)
-            with torch.no_grad():
-                embeddings = model.get_image_features(**inputs).cpu().numpy()
-        else:
-            raise ValueError("Either texts or images must be provided")
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        precision = autocast(device_type='cuda') if device.type == 'cuda' else contextlib.nullcontext()
+        with precision, torch.no_grad():
+            if texts:
+                inputs = processor(text=batch, return_tensors="pt", padding="max_length", truncation=True).to(device)
+                if text_only:
+                    features = model(**inputs).pooler_output
+                else:
+                    features = model.get_text_features(**inputs)
+            else:
+                inputs = processor(images=[_load_image(image) for image in batch], return_tensors="pt").to(device)
+                features = model.get_image_features(**inputs)
+        embeddings = features.float().cpu().numpy()
+        del inputs, features
+        yield start, embeddings
+    if device.type == 'cuda':
         torch.cuda.empty_cache()
-        return embeddings
 
-async def generate_tailored_response(llm_model, llm_tokenizer, query: str, chunks: list[str], max_length: int = 200):
-    context = " [SEP] ".join(chunks[:3]) if len(chunks) > 1 else chunks[0] if chunks else ""
+def encode_with_siglip(model, processor, texts=None, images=None, batch_size=None):
+    total = len(texts) if texts else len(images) if images else 0
+    embeddings = None
+    for start, batch in iter_siglip_embeddings(model, processor, texts=texts, images=images, batch_size=batch_size):
+        if embeddings is None:
+            embeddings = np.empty((total, batch.shape[1]), dtype=np.float32)
+        embeddings[start:start + len(batch)] = batch
+    return embeddings
+
+def build_llm_prompt(llm_tokenizer, query: str, chunks: list[str]) -> str:
+    context = " [SEP] ".join(chunks[:LLM_CONTEXT_CHUNKS]) if len(chunks) > 1 else chunks[0] if chunks else ""
     system_message = "Answer briefly according to context."
     user_message = f"Context: {context}\n\nQuestion: {query}"
     
@@ -84,45 +163,17 @@ async def generate_tailored_response(llm_model, llm_tokenizer, query: str, chunk
         {"role": "system", "content": system_message},
         {"role": "user", "content": user_message}
     ]
-    text = llm_tokenizer.apply_chat_template(
+    return llm_tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True
     )
-    
-    device = next(llm_model.parameters()).device
-    model_inputs = llm_tokenizer(
-        [text],
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=2048,
-        return_attention_mask=True
-    ).to(device)
-    
-    loop = asyncio.get_event_loop()
-    def run_llm():
-        generated_ids = llm_model.generate(
-            input_ids=model_inputs.input_ids,
-            attention_mask=model_inputs.attention_mask,
-            max_new_tokens=128,
-            num_beams=1,
-            top_p=0.7,
-            temperature=0.3,
-            use_cache=True,
-        )
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        response = llm_tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-        return response
-    
-    response = await loop.run_in_executor(None, run_llm)
 
+def trim_incomplete_sentence(response: str) -> str:
     sentences = [s.strip() for s in response.split('.') if s.strip()]
     if sentences:
         if not response.strip().endswith(('.', '!', '?')):
             sentences = sentences[:-1]
             response = ' '.join(sentences) + '.' if sentences else ''
     
-    return response.strip()
\ No newline at end of file
+    return response.strip()
@@ -1,117 +1,455 @@
 import faiss
 import numpy as np
+import asyncio
 import os
+import re
+import shutil
 from sqlalchemy.future import select
-from models.db_models import Document, TextChunk, ImageMetadata
+from models.db_models import Document
+from models.db_manager import get_chatwindow_row_ids
+from models.vector_store import VectorSegmentStore, VectorIdMap
+from utils.lru_cache import LRUCache
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATA_DIR = "data"
+INDEX_CACHE_MAX_WINDOWS = int(os.getenv("INDEX_CACHE_MAX_WINDOWS", "8"))
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_MB", "2048")) * 1024 * 1024
 
-def init_faiss(dimension=1152):
-    logger.info(f"Initializing FAISS index with dimension: {dimension}")
-    index = faiss.IndexFlatIP(dimension)
+# Index selection: "flat", "hnsw", "ivf", or "auto" (flat below INDEX_ANN_MIN_VECTORS, else ivf).
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+INDEX_ANN_MIN_VECTORS = int(os.getenv("INDEX_ANN_MIN_VECTORS", "50000"))
+INDEX_ENCODING = os.getenv("INDEX_ENCODING", "SQ8")
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "64"))
+INDEX_PCA_DIM = int(os.getenv("INDEX_PCA_DIM", "0"))
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+INDEX_HNSW_EF_SEARCH = int(os.getenv("INDEX_HNSW_EF_SEARCH", "64"))
+INDEX_IVF_NPROBE = int(os.getenv("INDEX_IVF_NPROBE", "16"))
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "65536"))
+INDEX_FACTORY = os.getenv("INDEX_FACTORY", "")
+INDEX_RERANK = os.getenv("INDEX_RERANK", "false").lower() in ("1", "true", "yes")
+INDEX_RERANK_FACTOR = int(os.getenv("INDEX_RERANK_FACTOR", "4"))
+# Vectors appended to a window are searched exactly beside its index until there are this many.
+INDEX_DELTA_MAX_VECTORS = int(os.getenv("INDEX_DELTA_MAX_VECTORS", "8192"))
+
+_window_locks = {}
+# Content version of each window seen by this process, kept current by every segment write
+# so answer cache keys need no manifest read.
+_window_versions = {}
+
+def select_index_type(num_vectors: int, index_type: str = INDEX_TYPE) -> str:
+    if index_type != "auto":
+        return index_type
+    return "flat" if num_vectors < INDEX_ANN_MIN_VECTORS else "ivf"
+
+def index_factory_string(num_vectors: int, index_type: str = INDEX_TYPE, encoding: str = INDEX_ENCODING,
+                         pca_dim: int = INDEX_PCA_DIM) -> str:
+    """Build a FAISS factory string such as ``PCA256,IVF1024,SQ8`` or ``HNSW32,SQ8`` for a window."""
+    index_type = select_index_type(num_vectors, index_type)
+    if index_type == "flat":
+        return "Flat"
+    prefix = f"PCA{pca_dim}," if pca_dim else ""
+    if index_type == "hnsw":
+        if encoding == "PQ":
+            return f"{prefix}HNSW{INDEX_HNSW_M}_PQ{INDEX_PQ_M}"
+        return f"{prefix}HNSW{INDEX_HNSW_M}" + ("" if encoding == "Flat" else f",{encoding}")
+    if index_type == "ivf":
+        nlist = int(min(max(4 * np.sqrt(max(num_vectors, 1)), 16), 65536))
+        codes = f"PQ{INDEX_PQ_M}" if encoding == "PQ" else encoding
+        return f"{prefix}IVF{nlist},{codes}"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+def min_training_vectors(factory: str) -> int:
+    """Fewest vectors FAISS can train ``factory`` on: ``nlist`` for IVF, 256 codes per PQ
+    sub-quantizer, the output width for PCA and one vector for scalar quantizers."""
+    required = 0
+    for pattern, minimum in ((r"PCA[RW]*(\d+)", int), (r"IVF(\d+)", int),
+                             (r"PQ\d+(?:x(\d+))?", lambda bits: 2 ** int(bits or 8)), (r"SQ\w+", lambda _: 1)):
+        for match in re.finditer(pattern, factory):
+            required = max(required, minimum(match.group(1) if match.groups() else None))
+    return required
+
+def window_factory(num_vectors: int) -> str:
+    return INDEX_FACTORY or index_factory_string(num_vectors)
+
+def init_faiss(dimension=1152, num_vectors=0, factory=None):
+    factory = factory or window_factory(num_vectors)
+    if num_vectors < min_training_vectors(factory):
+        # Too few vectors to train on; search exactly until the window outgrows this
+        # and add_document_to_chatwindow drops it so the next load rebuilds it.
+        logger.info(f"{num_vectors} vectors are too few to train {factory}, using a flat index")
+        factory = "Flat"
+    logger.info(f"Initializing FAISS index with dimension: {dimension}, factory: {factory}")
+    if factory == "Flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+    index = faiss.index_factory(dimension, f"IDMap2,{factory}", faiss.METRIC_INNER_PRODUCT)
+    parameters = faiss.ParameterSpace()
+    for name, value in (("nprobe", INDEX_IVF_NPROBE), ("efSearch", INDEX_HNSW_EF_SEARCH)):
+        try:
+            parameters.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
     return index
 
-def add_embeddings(index, embeddings):
-    logger.info(f"Adding embeddings with shape: {embeddings.shape}")
-    if embeddings.shape[1] != index.d:
-        logger.error(f"Dimension mismatch: embedding dimension {embeddings.shape[1]} != index dimension {index.d}")
-        raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match index dimension {index.d}")
-    faiss.normalize_L2(embeddings)
-    index.add(embeddings)
+def train_index(index, vectors, sample_size: int = INDEX_TRAIN_SAMPLE):
+    """Train quantizers and PCA on a random sample of the window's own vectors."""
+    if index.is_trained:
+        return
+    if len(vectors) > sample_size:
+        sample = np.sort(np.random.default_rng(0).choice(len(vectors), sample_size, replace=False))
+        vectors = vectors[sample]
+    logger.info(f"Training FAISS index on {len(vectors)} vectors")
+    index.train(np.ascontiguousarray(vectors, dtype="float32"))
+
+class WindowIndex:
+    """A window's published index: the FAISS index built from its segment plus a delta
+    of the vectors appended since.
+
+    The delta is a plain matrix scored exactly next to ``base``, so publishing an
+    ingest batch copies only the delta instead of cloning the whole index. Once it
+    holds more than ``INDEX_DELTA_MAX_VECTORS`` it is added to a clone of ``base``;
+    compaction reloads the window, which folds it in as well. Instances are never
+    modified after they are published.
+    """
+
+    def __init__(self, base, delta_vectors=None, delta_ids=None):
+        self.base = base
+        self.delta_vectors = np.empty((0, base.d), dtype="float32") if delta_vectors is None else delta_vectors
+        self.delta_ids = np.empty(0, dtype="int64") if delta_ids is None else delta_ids
+
+    @property
+    def d(self) -> int:
+        return self.base.d
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + len(self.delta_ids)
 
-def search_embeddings(index, query_vector, top_k=3):
-    logger.info(f"Searching FAISS index with query shape: {query_vector.shape}")
+    @property
+    def nbytes(self) -> int:
+        return index_nbytes(self.base) + self.delta_vectors.nbytes + self.delta_ids.nbytes
+
+    def search(self, query_vectors, top_k: int):
+        scores, indices = self.base.search(query_vectors, top_k)
+        if not len(self.delta_ids):
+            return scores, indices
+        delta_scores = query_vectors @ self.delta_vectors.T
+        scores = np.concatenate([scores, delta_scores], axis=1)
+        indices = np.concatenate([indices, np.broadcast_to(self.delta_ids, delta_scores.shape)], axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def append(self, vectors, ids) -> "WindowIndex":
+        if vectors.shape[1] != self.d:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match index dimension {self.d}")
+        delta_vectors = np.concatenate([self.delta_vectors, vectors])
+        delta_ids = np.concatenate([self.delta_ids, np.asarray(ids, dtype="int64")])
+        if len(delta_ids) <= INDEX_DELTA_MAX_VECTORS:
+            return WindowIndex(self.base, delta_vectors, delta_ids)
+        logger.info(f"Merging {len(delta_ids)} appended vectors into the window index")
+        base = faiss.clone_index(self.base)
+        base.add_with_ids(delta_vectors, delta_ids)
+        return WindowIndex(base)
+
+    def remove(self, vector_ids) -> "WindowIndex":
+        in_delta = np.isin(self.delta_ids, vector_ids)
+        base = self.base
+        if len(vector_ids) > in_delta.sum():
+            base = faiss.clone_index(base)
+            remove_vectors(base, vector_ids)
+        return WindowIndex(base, self.delta_vectors[~in_delta], self.delta_ids[~in_delta])
+
+def _inner_index(index):
+    if isinstance(index, WindowIndex):
+        index = index.base
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else faiss.downcast_index(index)
+    if isinstance(inner, faiss.IndexPreTransform):
+        inner = faiss.downcast_index(inner.index)
+    return inner
+
+def is_exact(index) -> bool:
+    return isinstance(_inner_index(index), faiss.IndexFlat)
+
+def index_nbytes(index) -> int:
+    """Approximate resident size of an id-mapped index: codes, graph links or lists, and the id map."""
+    if isinstance(index, WindowIndex):
+        return index.nbytes
+    inner = _inner_index(index)
+    n = index.ntotal
+    size = n * 16
+    if isinstance(inner, faiss.IndexHNSW):
+        storage = faiss.downcast_index(inner.storage)
+        size += n * getattr(storage, "code_size", storage.d * 4) + n * inner.hnsw.nb_neighbors(0) * 4 * 1.1
+    elif isinstance(inner, faiss.IndexIVF):
+        size += n * (inner.code_size + 8) + inner.nlist * inner.d * 4
+    else:
+        size += n * getattr(inner, "code_size", inner.d * 4)
+    return int(size)
+
+def add_rows(index, all_ids, vectors, rows, positions=None):
+    """Bulk-add normalized segment ``vectors`` and their ``rows`` to the index and id map."""
+    if not len(rows):
+        return
+    if vectors.shape[1] != index.d:
+        raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match index dimension {index.d}")
+    index.add_with_ids(vectors, np.ascontiguousarray(rows["vector_id"]))
+    all_ids.add(rows["vector_id"], rows["kind"], rows["row_id"], positions)
+
+def remove_vectors(index, vector_ids):
+    vector_ids = np.asarray(vector_ids, dtype='int64')
+    if len(vector_ids) == 0:
+        return 0
+    try:
+        removed = index.remove_ids(faiss.IDSelectorBatch(vector_ids))
+    except RuntimeError:
+        # HNSW graphs cannot drop nodes; search_embeddings over-fetches and skips hits
+        # that are no longer in all_ids until compaction triggers a rebuild.
+        logger.info(f"Index does not support removal, {len(vector_ids)} vectors left as stale entries")
+        return 0
+    logger.info(f"Removed {removed} vectors from index, index_size={index.ntotal}")
+    return removed
+
+def rerank_exact(all_ids, query_vector, scores, indices, top_k):
+    """Re-score an approximate shortlist with the full-precision vectors from the window's segment."""
+    if all_ids is None or all_ids.store is None:
+        return None
+    candidates = indices[0][indices[0] != -1]
+    positions = all_ids.segment_positions(candidates)
+    known = positions >= 0
+    candidates, positions = candidates[known], positions[known]
+    if not len(candidates):
+        return None
+    order = np.argsort(positions)
+    vectors = all_ids.store.gather(positions[order], all_ids.generation)
+    if vectors is None:
+        return None
+    exact = np.empty(len(candidates), dtype="float32")
+    exact[order] = vectors @ query_vector[0]
+    best = np.argsort(-exact)[:top_k]
+    reranked_scores = np.full((1, top_k), -np.inf, dtype="float32")
+    reranked_indices = np.full((1, top_k), -1, dtype="int64")
+    reranked_scores[0, :len(best)] = exact[best]
+    reranked_indices[0, :len(best)] = candidates[best]
+    return reranked_scores, reranked_indices
+
+def drop_stale(all_ids, scores, indices, top_k):
+    """Keep the first ``top_k`` hits that are still in ``all_ids``, padding with -1 like FAISS."""
+    live = np.fromiter((idx != -1 and idx in all_ids for idx in indices[0]), dtype=bool, count=indices.shape[1])
+    kept_scores = np.full((1, top_k), -np.inf, dtype="float32")
+    kept_indices = np.full((1, top_k), -1, dtype="int64")
+    hits = np.flatnonzero(live)[:top_k]
+    kept_scores[0, :len(hits)] = scores[0, hits]
+    kept_indices[0, :len(hits)] = indices[0, hits]
+    return kept_scores, kept_indices
+
+def search_embeddings(index, query_vector, top_k=3, all_ids=None):
     if query_vector.shape[1] != index.d:
         logger.error(f"Query dimension mismatch: query dimension {query_vector.shape[1]} != index dimension {index.d}")
         raise ValueError(f"Query dimension {query_vector.shape[1]} does not match index dimension {index.d}")
     faiss.normalize_L2(query_vector)
-    scores, indices = index.search(query_vector, top_k)
-    logger.info(f"FAISS search returned scores: {scores[0].tolist()}, indices: {indices[0].tolist()}")
+    # Vectors of deleted documents that the index could not remove (HNSW) until compaction;
+    # fetch that many more so they never take the place of live hits.
+    stale = max(index.ntotal - len(all_ids), 0) if all_ids is not None else 0
+    if INDEX_RERANK and all_ids is not None and not is_exact(index):
+        scores, indices = index.search(query_vector, top_k * INDEX_RERANK_FACTOR + stale)
+        reranked = rerank_exact(all_ids, query_vector, scores, indices, top_k)
+        if reranked is not None:
+            scores, indices = reranked
+        else:
+            scores, indices = drop_stale(all_ids, scores, indices, top_k)
+    else:
+        scores, indices = index.search(query_vector, top_k + stale)
+        if stale:
+            scores, indices = drop_stale(all_ids, scores, indices, top_k)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"FAISS search returned scores: {scores[0].tolist()}, indices: {indices[0].tolist()}")
     return scores, indices
 
-async def load_chatwindow_data(db, chatwindow_id: str, dimension=1152):
-    index = init_faiss(dimension)
-    all_ids = []
-    current_id = 0
+def get_vector_store(chatwindow_id: str, dimension=1152):
+    return VectorSegmentStore(os.path.join(DATA_DIR, chatwindow_id), dimension)
 
+def _record_version(chatwindow_id: str, store):
+    _window_versions[chatwindow_id] = store.version()
+
+async def chatwindow_version(chatwindow_id: str) -> int:
+    version = _window_versions.get(chatwindow_id)
+    if version is None:
+        loop = asyncio.get_event_loop()
+        version = await loop.run_in_executor(None, lambda: get_vector_store(chatwindow_id).version())
+        # A write that finished while the manifest was read has recorded a newer version.
+        version = _window_versions.setdefault(chatwindow_id, version)
+    return version
+
+async def migrate_legacy_embeddings(db, store, chatwindow_id: str):
+    """Copy per-document ``.npy`` embeddings of a window into its segment store."""
     documents = await db.execute(select(Document).filter(Document.chatwindow_id == chatwindow_id))
     documents = documents.scalars().all()
-    logger.info(f"Found {len(documents)} documents for chatwindow: {chatwindow_id}")
-
-    text_count = 0
-    image_count = 0
-    for doc in documents:
-        logger.info(f"Loading text embeddings from: {doc.embedding_path}")
+    legacy = [doc for doc in documents if doc.embedding_path and doc.embedding_path.endswith(".npy")]
+    if not legacy:
+        return
+    logger.info(f"Migrating {len(legacy)} legacy documents of chatwindow {chatwindow_id} to segment store")
+    chunk_ids, image_ids = await get_chatwindow_row_ids(db, chatwindow_id)
+    for doc in legacy:
         try:
-            text_embeddings = np.load(doc.embedding_path)
-            logger.info(f"Text embeddings shape: {text_embeddings.shape}")
-            chunks = await db.execute(
-                select(TextChunk).filter(TextChunk.document_id == doc.id).order_by(TextChunk.chunk_index)
-            )
-            chunks = chunks.scalars().all()
-            logger.info(f"Found {len(chunks)} text chunks for document: {doc.id}")
-            for i, embedding in enumerate(text_embeddings):
-                if embedding.shape[0] != dimension:
-                    logger.error(f"Text embedding dimension mismatch for chunk {i}: {embedding.shape[0]} != {dimension}")
-                    continue
-                add_embeddings(index, embedding[np.newaxis, :])
-                all_ids.append(('text', chunks[i].id))
-                text_count += 1
-                current_id += 1
+            store.append(doc.id, 'text', chunk_ids.get(doc.id, []), np.load(doc.embedding_path))
         except Exception as e:
-            logger.error(f"Failed to load text embeddings for document {doc.id}: {str(e)}")
+            logger.error(f"Failed to migrate text embeddings for document {doc.id}: {str(e)}")
 
         if doc.image_embedding_path and os.path.exists(doc.image_embedding_path):
-            logger.info(f"Loading image embeddings from: {doc.image_embedding_path}")
             try:
-                image_embeddings = np.load(doc.image_embedding_path)
-                logger.info(f"Image embeddings shape: {image_embeddings.shape}")
-                images = await db.execute(
-                    select(ImageMetadata).filter(ImageMetadata.document_id == doc.id)
-                )
-                images = images.scalars().all()
-                logger.info(f"Found {len(images)} image metadata for document: {doc.id}")
-                for i, embedding in enumerate(image_embeddings):
-                    if embedding.shape[0] != dimension:
-                        logger.error(f"Image embedding dimension mismatch for image {i}: {embedding.shape[0]} != {dimension}")
-                        continue
-                    add_embeddings(index, embedding[np.newaxis, :])
-                    all_ids.append(('image', images[i].id))
-                    image_count += 1
-                    current_id += 1
+                store.append(doc.id, 'image', image_ids.get(doc.id, []), np.load(doc.image_embedding_path))
             except Exception as e:
-                logger.error(f"Failed to load image embeddings for document {doc.id}: {str(e)}")
+                logger.error(f"Failed to migrate image embeddings for document {doc.id}: {str(e)}")
+    _record_version(chatwindow_id, store)
+
+def build_chatwindow_index(store, dimension=1152):
+    vectors, rows, positions = store.read()
+    index = init_faiss(dimension, len(rows))
+    train_index(index, vectors)
+    all_ids = VectorIdMap()
+    all_ids.store = store
+    all_ids.generation = store.generation()
+    add_rows(index, all_ids, vectors, rows, positions)
+    return WindowIndex(index), all_ids
+
+async def load_chatwindow_data(db, chatwindow_id: str, dimension=1152):
+    store = get_vector_store(chatwindow_id, dimension)
+    if not store.exists():
+        await migrate_legacy_embeddings(db, store, chatwindow_id)
 
-    logger.info(f"Loaded {index.ntotal} embeddings for chatwindow {chatwindow_id}: {text_count} text, {image_count} images")
+    loop = asyncio.get_event_loop()
+    index, all_ids = await loop.run_in_executor(None, lambda: build_chatwindow_index(store, dimension))
+    logger.info(f"Loaded {index.ntotal} embeddings for chatwindow {chatwindow_id}")
     return index, all_ids
 
-def save_embeddings(chatwindow_id: str, doc_name: str, embeddings_np, is_image=False):
-    chat_dir = os.path.join(DATA_DIR, chatwindow_id)
-    os.makedirs(chat_dir, exist_ok=True)
-    prefix = "image" if is_image else "text"
-    embedding_path = os.path.join(chat_dir, f"{prefix}_{doc_name}.npy")
-    logger.info(f"Saving embeddings to: {embedding_path}, shape: {embeddings_np.shape}")
-    np.save(embedding_path, embeddings_np)
-    return embedding_path
+def chatwindow_data_size(entry):
+    index, all_ids = entry
+    return index_nbytes(index) + all_ids.nbytes
+
+def create_index_cache():
+    return LRUCache(
+        max_entries=INDEX_CACHE_MAX_WINDOWS,
+        max_bytes=INDEX_CACHE_MAX_BYTES,
+        sizeof=chatwindow_data_size
+    )
+
+def window_lock(chatwindow_id: str) -> asyncio.Lock:
+    """Serializes loads and updates of one window; searches never take it."""
+    return _window_locks.setdefault(chatwindow_id, asyncio.Lock())
+
+async def _load_into_cache(cache, db, chatwindow_id: str, dimension=1152):
+    logger.info(f"Index cache miss for chatwindow: {chatwindow_id}")
+    entry = await load_chatwindow_data(db, chatwindow_id, dimension)
+    if not cache.put(chatwindow_id, entry):
+        logger.warning(f"Index for chatwindow {chatwindow_id} exceeds cache budget, not cached")
+    return entry
+
+async def get_chatwindow_data(cache, db, chatwindow_id: str, dimension=1152):
+    """Return the current ``(index, all_ids)`` snapshot of a window, loading it once on a miss.
+
+    Snapshots are never modified after they are published, so callers may search
+    them from any thread while updates build and swap in a replacement.
+    """
+    entry = cache.get(chatwindow_id)
+    if entry is not None:
+        logger.debug(f"Index cache hit for chatwindow: {chatwindow_id}")
+        return entry
+    async with window_lock(chatwindow_id):
+        entry = cache.peek(chatwindow_id)
+        if entry is not None:
+            return entry
+        return await _load_into_cache(cache, db, chatwindow_id, dimension)
+
+def extend_snapshot(entry, segments):
+    index, all_ids = entry
+    all_ids = all_ids.copy()
+    for vectors, rows, positions in segments:
+        if len(rows):
+            index = index.append(vectors, rows["vector_id"])
+            all_ids.add(rows["vector_id"], rows["kind"], rows["row_id"], positions)
+    return index, all_ids
+
+def shrink_snapshot(entry, vector_ids):
+    index, all_ids = entry
+    vector_ids = np.asarray(vector_ids, dtype="int64")
+    if not len(vector_ids):
+        return entry
+    all_ids = all_ids.copy()
+    all_ids.remove(vector_ids)
+    return index.remove(vector_ids), all_ids
+
+async def add_document_to_chatwindow(cache, chatwindow_id: str, doc_id: str, text_ids, text_embeddings, image_ids=None, image_embeddings=None):
+    """Append a batch to the window's segment store and, if the window is cached, to its snapshot.
+
+    Windows that are not cached are only appended to; the next search loads them.
+    """
+    store = get_vector_store(chatwindow_id)
+    loop = asyncio.get_event_loop()
+    async with window_lock(chatwindow_id):
+        segments = []
+        if text_ids:
+            segments.append(await loop.run_in_executor(None, lambda: store.append(doc_id, 'text', text_ids, text_embeddings)))
+        if image_ids:
+            segments.append(await loop.run_in_executor(None, lambda: store.append(doc_id, 'image', image_ids, image_embeddings)))
+        await loop.run_in_executor(None, lambda: _record_version(chatwindow_id, store))
+
+        entry = cache.peek(chatwindow_id)
+        if entry is None:
+            return None
+        index, all_ids = entry
+        total = index.ntotal + sum(len(rows) for _, rows, _ in segments)
+        factory = window_factory(total)
+        if is_exact(index) and factory != "Flat" and total >= min_training_vectors(factory):
+            logger.info(f"Chatwindow {chatwindow_id} outgrew the flat index, rebuilding as {factory} on next use")
+            cache.invalidate(chatwindow_id)
+            return None
+        entry = await loop.run_in_executor(None, lambda: extend_snapshot(entry, segments))
+        cache.put(chatwindow_id, entry)
+    logger.info(f"Appended document vectors to chatwindow {chatwindow_id}, index_size={entry[0].ntotal}")
+    return entry
+
+async def remove_document_from_chatwindow(cache, chatwindow_id: str, doc_id: str):
+    """Tombstone a document's vectors and publish a snapshot without them; returns the tombstoned ids.
+
+    Runs under the window lock so the tombstone lands between, never inside, an
+    ingest batch or a compaction of the same window.
+    """
+    loop = asyncio.get_event_loop()
+    async with window_lock(chatwindow_id):
+        vector_ids = await loop.run_in_executor(None, lambda: delete_document(chatwindow_id, doc_id))
+        entry = cache.peek(chatwindow_id)
+        if entry is not None:
+            entry = await loop.run_in_executor(None, lambda: shrink_snapshot(entry, vector_ids))
+            cache.put(chatwindow_id, entry)
+    return vector_ids
+
+def compact_chatwindow_store(chatwindow_id: str) -> bool:
+    store = get_vector_store(chatwindow_id)
+    if store.needs_compaction():
+        store.compact()
+        return True
+    return False
+
+async def compact_chatwindow(cache, chatwindow_id: str):
+    loop = asyncio.get_event_loop()
+    async with window_lock(chatwindow_id):
+        if await loop.run_in_executor(None, lambda: compact_chatwindow_store(chatwindow_id)):
+            # Cached row positions point into the old generation, and HNSW indexes still
+            # hold deleted vectors; reload on next use.
+            cache.invalidate(chatwindow_id)
 
 def delete_document(chatwindow_id: str, doc_id: str):
-    chat_dir = os.path.join(DATA_DIR, chatwindow_id)
-    for prefix in ["text", "image"]:
-        npy_path = os.path.join(chat_dir, f"{prefix}_{doc_id}.npy")
-        if os.path.exists(npy_path):
-            logger.info(f"Deleting embedding file: {npy_path}")
-            os.remove(npy_path)
+    store = get_vector_store(chatwindow_id)
+    vector_ids = store.tombstone(doc_id)
+    _record_version(chatwindow_id, store)
+    return vector_ids
 
 def delete_chatwindow(chatwindow_id: str):
+    _window_locks.pop(chatwindow_id, None)
+    _window_versions.pop(chatwindow_id, None)
     chat_dir = os.path.join(DATA_DIR, chatwindow_id)
     if os.path.exists(chat_dir):
-        for file in os.listdir(chat_dir):
-            if file.endswith(".npy"):
-                logger.info(f"Deleting embedding file: {os.path.join(chat_dir, file)}")
-                os.remove(os.path.join(chat_dir, file))
         logger.info(f"Removing directory: {chat_dir}")
-        os.rmdir(chat_dir)
\ No newline at end of file
+        shutil.rmtree(chat_dir)
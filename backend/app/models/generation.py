@@ -0,0 +1,505 @@
+from transformers import DynamicCache
+from models.embedding_model import (
+    load_llm_model,
+    build_llm_prompt,
+    trim_incomplete_sentence,
+    LLM_CONTEXT_CHUNKS,
+    LLM_MAX_PROMPT_TOKENS,
+    LLM_TEMPERATURE,
+    LLM_TOP_P,
+)
+from models.context_packer import pack_context, LLM_CONTEXT_TOKEN_BUDGET
+from utils.metrics import observe
+import asyncio
+import queue
+import threading
+import time
+import os
+import logging
+import torch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# "eager" loads the LLM alongside SigLIP and holds readiness until it is up, "background"
+# starts loading at startup without holding readiness, "on_demand" waits for the first
+# request that generates an answer.
+LLM_LOAD = os.getenv("LLM_LOAD", "eager")
+GEN_MAX_BATCH_SIZE = int(os.getenv("GEN_MAX_BATCH_SIZE", "8"))
+GEN_MAX_NEW_TOKENS = int(os.getenv("GEN_MAX_NEW_TOKENS", "128"))
+GEN_PREFIX_CACHE = os.getenv("GEN_PREFIX_CACHE", "true").lower() in ("1", "true", "yes")
+# Decoding: "sample" follows the model's generation config with LLM_TEMPERATURE and
+# LLM_TOP_P, like the model.generate call it replaced; "greedy" always takes the
+# likeliest token (the repetition penalty still applies).
+GEN_DECODING = os.getenv("GEN_DECODING", "sample")
+
+def sampling_settings(generation_config, decoding: str = GEN_DECODING) -> dict:
+    """The logits processing ``model.generate`` would apply for this scheduler's requests."""
+    do_sample = decoding == "sample" and bool(generation_config.do_sample) and LLM_TEMPERATURE > 0
+    return {
+        "do_sample": do_sample,
+        "temperature": LLM_TEMPERATURE if do_sample else 1.0,
+        "top_k": (generation_config.top_k or 0) if do_sample else 0,
+        "top_p": LLM_TOP_P if do_sample else 1.0,
+        "repetition_penalty": generation_config.repetition_penalty or 1.0,
+    }
+
+def shared_prompt_prefix(tokenizer) -> list[int]:
+    """Token ids every answer prompt starts with: the chat template up to where the context begins."""
+    first, second = (
+        tokenizer([build_llm_prompt(tokenizer, query, [context])], return_tensors="pt").input_ids[0].tolist()
+        for query, context in (("first question", "alpha"), ("second query", "omega"))
+    )
+    length = 0
+    while length < min(len(first), len(second)) and first[length] == second[length]:
+        length += 1
+    return first[:length]
+
+def _left_pad(tensor, length: int, dim: int):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class _Sequence:
+    """One request inside the scheduler; the scheduler thread posts its events to the caller's loop."""
+
+    def __init__(self, prompt_ids: list[int], max_new_tokens: int, loop):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.generated = 0
+        self.cancelled = False
+        self.submitted_at = time.perf_counter()
+        self.loop = loop
+        self.events = asyncio.Queue()
+
+    def emit(self, kind: str, value=None):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, (kind, value))
+
+class GenerationScheduler:
+    """Continuous-batching decoder shared by every answer-generation request.
+
+    Prompts queue up and are admitted into one running batch between decode steps,
+    up to ``max_batch_size`` sequences. New prompts are prefilled together, and their
+    key/value cache is left-padded and concatenated onto the running batch's cache;
+    finished or abandoned sequences are dropped from it after each step. Every step
+    therefore runs one forward pass for all active sequences, instead of one
+    ``generate`` call per request competing for the model.
+
+    With ``prefix_cache`` the chat-template prefix shared by every prompt (system
+    message included) is prefilled once when the scheduler starts; prompts that
+    begin with it only prefill their own context and question, on top of a copy
+    of that key/value state.
+
+    Retrieved chunks are packed into ``context_budget`` tokens before the prompt is
+    built (see ``pack_context``); ``None`` sends them unchanged.
+
+    Each step applies the repetition penalty, temperature, top-k and top-p of
+    ``sampling_settings`` to every row's logits, as ``model.generate`` does, and
+    samples the next tokens together; ``decoding="greedy"`` takes the argmax instead.
+
+    The loop runs on a dedicated thread and hands tokens back to each caller's
+    event loop as they are produced, so the same path serves buffered and streamed
+    answers.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = GEN_MAX_BATCH_SIZE,
+                 max_new_tokens: int = GEN_MAX_NEW_TOKENS, prefix_cache: bool = GEN_PREFIX_CACHE,
+                 context_budget: int = LLM_CONTEXT_TOKEN_BUDGET, decoding: str = GEN_DECODING):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.prefix_cache = prefix_cache
+        self.context_budget = context_budget
+        self._prefix_ids = []
+        self._prefix_kv = None
+        self.device = next(model.parameters()).device
+        eos = model.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos] if eos is not None else [])
+        if tokenizer.eos_token_id is not None:
+            self.eos_token_ids.add(tokenizer.eos_token_id)
+        self.pad_token_id = tokenizer.pad_token_id or 0
+        self.sampling = sampling_settings(model.generation_config, decoding)
+        self._pending = queue.Queue()
+        self._thread = None
+        self._sequences = []
+        self._cache = None
+        self._mask = None
+        self._next = None
+        # Which vocabulary ids each row has seen so far, for the repetition penalty.
+        self._seen = None
+        self.requests = 0
+        self.completed = 0
+        self.prefill_tokens = 0
+        self.generated_tokens = 0
+        self.decode_steps = 0
+        self.occupied_slots = 0
+        self.busy_seconds = 0.0
+        self.prefill_seconds = 0.0
+        self.prefix_hits = 0
+        self.first_tokens = 0
+        self.first_token_seconds = 0.0
+        self.packed_prompts = 0
+        self.context_tokens_in = 0
+        self.context_tokens_out = 0
+        self.packing_seconds = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is not None:
+            self._pending.put(None)
+            await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+            self._thread = None
+
+    def submit(self, prompt: str, max_new_tokens: int = None) -> _Sequence:
+        if self._thread is None:
+            raise RuntimeError("Generation scheduler is not running")
+        prompt_ids = self.tokenizer(
+            [prompt], return_tensors="pt", truncation=True, max_length=LLM_MAX_PROMPT_TOKENS
+        ).input_ids[0].tolist()
+        sequence = _Sequence(prompt_ids, max_new_tokens or self.max_new_tokens, asyncio.get_running_loop())
+        self.requests += 1
+        self._pending.put(sequence)
+        return sequence
+
+    def build_prompt(self, query: str, chunks: list[str]) -> str:
+        if self.context_budget is None:
+            return build_llm_prompt(self.tokenizer, query, chunks)
+        packed, report = pack_context(self.tokenizer, query, chunks[:LLM_CONTEXT_CHUNKS], self.context_budget)
+        self.packed_prompts += 1
+        self.context_tokens_in += report["tokens_in"]
+        self.context_tokens_out += report["tokens_out"]
+        self.packing_seconds += report["ms"] / 1000
+        observe("context_packing", report["ms"] / 1000)
+        logger.debug(f"Packed context from {report['tokens_in']} to {report['tokens_out']} tokens in {report['ms']:.1f}ms")
+        return build_llm_prompt(self.tokenizer, query, packed)
+
+    async def _token_ids(self, sequence: _Sequence):
+        try:
+            while True:
+                kind, value = await sequence.events.get()
+                if kind == "token":
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            # Picked up at the next step: the sequence leaves the batch and frees its slot.
+            sequence.cancelled = True
+
+    async def generate(self, query: str, chunks: list[str]) -> str:
+        sequence = self.submit(self.build_prompt(query, chunks))
+        token_ids = [token_id async for token_id in self._token_ids(sequence)]
+        return trim_incomplete_sentence(self.tokenizer.decode(token_ids, skip_special_tokens=True))
+
+    async def stream(self, query: str, chunks: list[str]):
+        """Yield answer text pieces as tokens are decoded; closing the generator cancels the sequence."""
+        sequence = self.submit(self.build_prompt(query, chunks))
+        token_ids = []
+        emitted = 0
+        tokens = self._token_ids(sequence)
+        try:
+            async for token_id in tokens:
+                token_ids.append(token_id)
+                text = self.tokenizer.decode(token_ids, skip_special_tokens=True)
+                # Hold back partial multi-byte characters until the next token completes them.
+                if len(text) > emitted and not text.endswith("�"):
+                    yield text[emitted:]
+                    emitted = len(text)
+        finally:
+            await tokens.aclose()
+
+    def _build_prefix_cache(self):
+        prefix_ids = shared_prompt_prefix(self.tokenizer)
+        if not prefix_ids:
+            logger.warning("Prompts share no token prefix, prefix cache disabled")
+            return
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=torch.tensor([prefix_ids], device=self.device),
+                past_key_values=DynamicCache(), use_cache=True
+            )
+        self._prefix_ids = prefix_ids
+        self._prefix_kv = outputs.past_key_values.to_legacy_cache()
+        logger.info(f"Cached key/value state of the {len(prefix_ids)}-token prompt prefix")
+
+    def _has_prefix(self, sequence: _Sequence) -> bool:
+        length = len(self._prefix_ids)
+        return bool(length) and len(sequence.prompt_ids) > length and sequence.prompt_ids[:length] == self._prefix_ids
+
+    def _run(self):
+        if self.prefix_cache:
+            try:
+                self._build_prefix_cache()
+            except Exception as e:
+                logger.error(f"Failed to build prompt prefix cache: {str(e)}", exc_info=True)
+        stopping = False
+        while not stopping:
+            admitted = []
+            if not self._sequences:
+                sequence = self._pending.get()
+                if sequence is None:
+                    break
+                admitted.append(sequence)
+            while len(self._sequences) + len(admitted) < self.max_batch_size:
+                try:
+                    sequence = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if sequence is None:
+                    stopping = True
+                    break
+                admitted.append(sequence)
+            admitted = [sequence for sequence in admitted if not sequence.cancelled]
+            started = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    with_prefix = [sequence for sequence in admitted if self._has_prefix(sequence)]
+                    if with_prefix:
+                        self._prefill(with_prefix, use_prefix=True)
+                    if len(with_prefix) < len(admitted):
+                        self._prefill([sequence for sequence in admitted if sequence not in with_prefix])
+                    if self._sequences:
+                        self._decode_step()
+            except Exception as e:
+                logger.error(f"Generation step failed for {len(self._sequences) + len(admitted)} sequences: {str(e)}",
+                             exc_info=True)
+                for sequence in set(self._sequences) | set(admitted):
+                    sequence.emit("error", e)
+                self._reset()
+            self.busy_seconds += time.perf_counter() - started
+
+        for sequence in self._sequences:
+            sequence.emit("error", RuntimeError("Generation scheduler stopped"))
+        self._reset()
+        while not self._pending.empty():
+            sequence = self._pending.get_nowait()
+            if sequence is not None:
+                sequence.emit("error", RuntimeError("Generation scheduler stopped"))
+
+    def _reset(self):
+        self._sequences, self._cache, self._mask, self._next, self._seen = [], None, None, None, None
+
+    def _prefill(self, sequences: list[_Sequence], use_prefix: bool = False):
+        started = time.perf_counter()
+        skip = len(self._prefix_ids) if use_prefix else 0
+        prompts = [sequence.prompt_ids[skip:] for sequence in sequences]
+        width = max(len(prompt) for prompt in prompts)
+        input_ids = torch.tensor(
+            [[self.pad_token_id] * (width - len(prompt)) + prompt for prompt in prompts], device=self.device
+        )
+        mask = torch.tensor(
+            [[0] * (width - len(prompt)) + [1] * len(prompt) for prompt in prompts], device=self.device
+        )
+        position_ids = skip + (mask.cumsum(-1) - 1).clamp(min=0)
+        if use_prefix:
+            # Rows read as [prefix | padding | prompt]; the padding is masked and positions
+            # continue from the prefix, so attention sees the same thing as a full prefill.
+            past = DynamicCache.from_legacy_cache(tuple(
+                (k.expand(len(sequences), -1, -1, -1), v.expand(len(sequences), -1, -1, -1)) for k, v in self._prefix_kv
+            ))
+            mask = torch.cat([mask.new_ones((len(sequences), skip)), mask], dim=1)
+            self.prefix_hits += len(sequences)
+        else:
+            past = DynamicCache()
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=mask, position_ids=position_ids,
+            past_key_values=past, use_cache=True
+        )
+        self.prefill_tokens += int(mask.sum()) - skip * len(sequences)
+        logits = outputs.logits[:, -1, :]
+        seen = None
+        if self.sampling["repetition_penalty"] != 1.0:
+            width = max(len(sequence.prompt_ids) for sequence in sequences)
+            prompt_ids = torch.tensor(
+                [sequence.prompt_ids + sequence.prompt_ids[:1] * (width - len(sequence.prompt_ids)) for sequence in sequences],
+                device=self.device
+            )
+            seen = torch.zeros(logits.shape, dtype=torch.bool, device=self.device).scatter_(1, prompt_ids, True)
+        next_tokens = self._select(logits, seen)
+        cache = outputs.past_key_values.to_legacy_cache()
+        first = len(self._sequences)
+        if self._cache is None:
+            self._cache, self._mask, self._next, self._seen = cache, mask, next_tokens, seen
+        else:
+            length = max(self._mask.shape[1], mask.shape[1])
+            self._cache = tuple(
+                (torch.cat([_left_pad(k, length, 2), _left_pad(new_k, length, 2)]),
+                 torch.cat([_left_pad(v, length, 2), _left_pad(new_v, length, 2)]))
+                for (k, v), (new_k, new_v) in zip(self._cache, cache)
+            )
+            self._mask = torch.cat([_left_pad(self._mask, length, 1), _left_pad(mask, length, 1)])
+            self._next = torch.cat([self._next, next_tokens])
+            if seen is not None:
+                self._seen = torch.cat([self._seen, seen])
+        self._sequences.extend(sequences)
+        self.prefill_seconds += time.perf_counter() - started
+        observe("llm_prefill", time.perf_counter() - started)
+        self._advance(range(first, len(self._sequences)))
+
+    def _decode_step(self):
+        started = time.perf_counter()
+        batch_size = len(self._sequences)
+        mask = torch.cat([self._mask, self._mask.new_ones((batch_size, 1))], dim=1)
+        position_ids = mask.sum(-1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=self._next[:, None], attention_mask=mask, position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self._cache), use_cache=True
+        )
+        self._cache = outputs.past_key_values.to_legacy_cache()
+        self._mask = mask
+        self._next = self._select(outputs.logits[:, -1, :], self._seen)
+        self.decode_steps += 1
+        self.occupied_slots += batch_size
+        observe("llm_decode_step", time.perf_counter() - started)
+        self._advance(range(batch_size))
+
+    def _select(self, logits, seen):
+        """Pick each row's next token from its last logits; marks the picks in ``seen``."""
+        settings = self.sampling
+        logits = logits.float()
+        if seen is not None:
+            penalty = settings["repetition_penalty"]
+            logits = torch.where(seen, torch.where(logits > 0, logits / penalty, logits * penalty), logits)
+        if not settings["do_sample"]:
+            next_tokens = logits.argmax(-1)
+        else:
+            logits = logits / settings["temperature"]
+            if settings["top_k"]:
+                # topk comes back sorted, so top-p only has to look at the k candidates.
+                logits, candidates = logits.topk(min(settings["top_k"], logits.shape[-1]), dim=-1)
+            else:
+                logits, candidates = logits.sort(dim=-1, descending=True)
+            if settings["top_p"] < 1.0:
+                probs = logits.softmax(-1)
+                # Keep the smallest prefix whose probability reaches top_p, and always the best token.
+                outside = probs.cumsum(-1) - probs >= settings["top_p"]
+                outside[:, 0] = False
+                logits = logits.masked_fill(outside, float("-inf"))
+            picked = torch.multinomial(logits.softmax(-1), 1)
+            next_tokens = candidates.gather(1, picked).squeeze(1)
+        if seen is not None:
+            seen[torch.arange(len(next_tokens), device=seen.device), next_tokens] = True
+        return next_tokens
+
+    def _advance(self, rows):
+        """Hand each row's newest token to its caller, then drop finished and cancelled rows."""
+        tokens = self._next.tolist()
+        for row in rows:
+            sequence = self._sequences[row]
+            if sequence.cancelled:
+                continue
+            token_id = tokens[row]
+            sequence.generated += 1
+            self.generated_tokens += 1
+            if sequence.generated == 1:
+                first_token_seconds = time.perf_counter() - sequence.submitted_at
+                self.first_tokens += 1
+                self.first_token_seconds += first_token_seconds
+                observe("llm_time_to_first_token", first_token_seconds)
+            if token_id in self.eos_token_ids:
+                sequence.cancelled = True
+            else:
+                sequence.emit("token", token_id)
+                if sequence.generated >= sequence.max_new_tokens:
+                    sequence.cancelled = True
+            if sequence.cancelled:
+                sequence.emit("done")
+                self.completed += 1
+        keep = [row for row, sequence in enumerate(self._sequences) if not sequence.cancelled]
+        if len(keep) == len(self._sequences):
+            return
+        if not keep:
+            self._reset()
+            return
+        index = torch.tensor(keep, device=self.device)
+        self._sequences = [self._sequences[row] for row in keep]
+        self._mask = self._mask.index_select(0, index)
+        self._next = self._next.index_select(0, index)
+        if self._seen is not None:
+            self._seen = self._seen.index_select(0, index)
+        # Columns that were only padding for the rows that left can go too.
+        start = int((self._mask.sum(0) > 0).nonzero()[0])
+        self._mask = self._mask[:, start:]
+        self._cache = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in self._cache
+        )
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "completed": self.completed,
+            "queue_depth": self._pending.qsize(),
+            "active": len(self._sequences),
+            "max_batch_size": self.max_batch_size,
+            "decode_steps": self.decode_steps,
+            "prefill_tokens": self.prefill_tokens,
+            "generated_tokens": self.generated_tokens,
+            "context_tokens_in": self.context_tokens_in,
+            "context_tokens_out": self.context_tokens_out,
+            "context_tokens_saved": self.context_tokens_in - self.context_tokens_out,
+            "avg_packing_ms": self.packing_seconds * 1000 / self.packed_prompts if self.packed_prompts else 0.0,
+            "prefix_tokens": len(self._prefix_ids),
+            "prefix_hits": self.prefix_hits,
+            "prefill_ms": self.prefill_seconds * 1000,
+            "avg_time_to_first_token_ms": (
+                self.first_token_seconds * 1000 / self.first_tokens if self.first_tokens else 0.0
+            ),
+            "tokens_per_second": self.generated_tokens / self.busy_seconds if self.busy_seconds else 0.0,
+            "batch_occupancy": (
+                self.occupied_slots / (self.decode_steps * self.max_batch_size) if self.decode_steps else 0.0
+            ),
+        }
+
+class LLMLoader:
+    """Loads the LLM at most once and serves it through a shared ``GenerationScheduler``.
+
+    ``get`` waits for a load already in flight instead of starting another, and a
+    failed load is retried by the next caller.
+    """
+
+    def __init__(self, readiness=None):
+        self.readiness = readiness
+        self.task = None
+
+    async def _load(self):
+        if self.readiness is not None:
+            model, tokenizer = await self.readiness.track("llm", load_llm_model())
+        else:
+            model, tokenizer = await load_llm_model()
+        scheduler = GenerationScheduler(model, tokenizer)
+        scheduler.start()
+        return scheduler
+
+    def start(self):
+        if self.task is None or (self.task.done() and (self.task.cancelled() or self.task.exception())):
+            self.task = asyncio.create_task(self._load())
+        return self.task
+
+    async def get(self) -> GenerationScheduler:
+        # Shielded so a client disconnecting mid-load does not cancel it for everyone else.
+        return await asyncio.shield(self.start())
+
+    @property
+    def loaded(self) -> bool:
+        return self.task is not None and self.task.done() and not self.task.cancelled() and self.task.exception() is None
+
+    @property
+    def scheduler(self):
+        return self.task.result() if self.loaded else None
+
+    async def unload(self):
+        if self.task is None:
+            return
+        if not self.task.done():
+            self.task.cancel()
+        elif self.loaded:
+            await self.task.result().stop()
+        self.task = None
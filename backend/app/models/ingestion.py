@@ -0,0 +1,394 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timezone
+from utils.text_utils import iter_page_batches, create_chunker
+from models.faiss_manager import (
+    add_document_to_chatwindow,
+    get_vector_store,
+    remove_document_from_chatwindow,
+)
+from models.bm25_index import add_chunks_to_bm25, remove_document_from_bm25, save_document_postings
+from models.db_manager import (
+    create_document,
+    create_text_chunks,
+    create_image_metadata,
+    delete_document as db_delete_document,
+    set_document_image_embedding_path,
+    update_image_pages,
+)
+from models.embedding_model import iter_siglip_embeddings
+from models.database import AsyncSessionLocal
+from utils.metrics import observe, span
+from PIL import Image
+import numpy as np
+import asyncio
+import io
+import os
+import time
+import uuid
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "1"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "200"))
+INGEST_TEXT_BATCH = int(os.getenv("INGEST_TEXT_BATCH", "128"))
+INGEST_IMAGE_BATCH = int(os.getenv("INGEST_IMAGE_BATCH", "32"))
+
+class IngestionJob:
+    def __init__(self, chatwindow_id: str, filename: str, pdf_path: str):
+        self.id = str(uuid.uuid4())
+        self.chatwindow_id = chatwindow_id
+        self.filename = filename
+        self.pdf_path = pdf_path
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = {
+            "pages_total": 0,
+            "pages_extracted": 0,
+            "chunks_total": 0,
+            "chunks_encoded": 0,
+            "images_total": 0,
+            "images_encoded": 0,
+            "images_deduplicated": 0,
+            "chunks_cached": 0,
+            "images_cached": 0,
+        }
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "chatwindow_uuid": self.chatwindow_id,
+            "filename": self.filename,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+def encode_with_progress(job: IngestionJob, counter: str, model, processor, texts=None, images=None, offset: int = 0):
+    total = len(texts) if texts else len(images)
+    embeddings = None
+    for start, batch in iter_siglip_embeddings(model, processor, texts=texts, images=images):
+        if embeddings is None:
+            embeddings = np.empty((total, batch.shape[1]), dtype=np.float32)
+        embeddings[start:start + len(batch)] = batch
+        job.progress[counter] = offset + start + len(batch)
+    return embeddings
+
+def encode_missing(job: IngestionJob, counter: str, cache, keys, model, processor, texts=None, images=None,
+                   offset: int = 0, cached=None):
+    """Encode only the items whose embedding is not already in ``cache``; returns ``(embeddings, skipped)``.
+
+    ``cached`` may carry vectors already looked up by the caller, in which case
+    ``images`` may hold ``None`` for those items so they never need decoding.
+    """
+    items = texts if texts is not None else images
+    if cache is None:
+        return encode_with_progress(job, counter, model, processor, texts=texts, images=images, offset=offset), 0
+    if cached is None:
+        cached = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    vectors = [cached.get(key) for key in keys]
+    if missing:
+        encoded = encode_with_progress(
+            job, counter, model, processor,
+            texts=[items[i] for i in missing] if texts is not None else None,
+            images=[items[i] for i in missing] if images is not None else None,
+            offset=offset
+        )
+        cache.put_many({keys[i]: encoded[j] for j, i in enumerate(missing)})
+        for j, i in enumerate(missing):
+            vectors[i] = encoded[j]
+    job.progress[counter] = offset + len(items)
+    return np.stack(vectors).astype(np.float32, copy=False), len(items) - len(missing)
+
+def paragraphs_of(page_texts):
+    for page_num, cleaned_page_text in page_texts:
+        for paragraph in cleaned_page_text.split('\n'):
+            if paragraph.strip():
+                yield page_num, paragraph.strip()
+
+async def discard_document(state, db, chatwindow_id: str, doc_id: str):
+    """Remove whatever part of a failed or cancelled upload was already stored and indexed."""
+    await db.rollback()
+    await db_delete_document(db, chatwindow_id, doc_id)
+    await remove_document_from_chatwindow(state.index_cache, chatwindow_id, doc_id)
+    remove_document_from_bm25(state.bm25_cache, chatwindow_id, doc_id)
+
+async def ingest_pdf(app, job: IngestionJob, executor):
+    """Extract, encode, persist and index one uploaded PDF, reporting progress on ``job``.
+
+    Pages are streamed in ranges and every ``INGEST_TEXT_BATCH`` chunks (or
+    ``INGEST_IMAGE_BATCH`` images) are encoded, stored and appended to the index before
+    the next range is read, so memory does not grow with the document and the pages
+    already processed become searchable while the rest is still running.
+    """
+    state = app.state
+    chatwindow_uuid = job.chatwindow_id
+    siglip_model = state.siglip_model
+    siglip_processor = state.siglip_processor
+    embedding_cache = state.embedding_cache
+    loop = asyncio.get_event_loop()
+
+    async with AsyncSessionLocal() as db:
+        embedding_path = get_vector_store(chatwindow_uuid).directory
+        logger.info(f"Creating document for chatwindow: {chatwindow_uuid}")
+        document = await create_document(db, chatwindow_uuid, job.filename, embedding_path)
+        logger.info(f"Created document ID: {document.id}")
+
+        chunker = create_chunker(getattr(state.siglip_processor, "tokenizer", None))
+        pending_chunks = []
+        pending_images = []
+        images_by_hash = {}
+        postings = ([], [])
+        stored = {"chunks": 0, "images": 0, "batches": 0}
+
+        async def store_text_batch(batch):
+            texts = [chunk for chunk, _ in batch]
+            keys = [embedding_cache.text_key(text) for text in texts] if embedding_cache else None
+            job.stage = "encoding_text"
+            with span("ingest_encode_text"):
+                embeddings, skipped = await loop.run_in_executor(
+                    executor,
+                    lambda: encode_missing(job, "chunks_encoded", embedding_cache, keys, siglip_model, siglip_processor,
+                                           texts=texts, offset=stored["chunks"])
+                )
+            job.progress["chunks_cached"] += skipped
+            job.stage = "indexing"
+            with span("ingest_db_insert"):
+                chunk_ids = await create_text_chunks(db, document.id, batch, offset=stored["chunks"])
+            with span("ingest_index_add"):
+                await add_document_to_chatwindow(
+                    state.index_cache, chatwindow_uuid, document.id, chunk_ids, embeddings
+                )
+            with span("ingest_bm25"):
+                vector_ids, term_counts = await add_chunks_to_bm25(
+                    state.bm25_cache, chatwindow_uuid, document.id, chunk_ids, texts
+                )
+            postings[0].extend(vector_ids)
+            postings[1].extend(term_counts)
+            stored["chunks"] += len(batch)
+            stored["batches"] += 1
+
+        def decode_and_save(batch, cached):
+            images = []
+            decoded_image_data = []
+            keys = []
+            os.makedirs("saved_images", exist_ok=True)
+            for img in batch:
+                key = embedding_cache.image_key(img["content_hash"]) if embedding_cache else None
+                try:
+                    image = None
+                    if key not in cached:
+                        with Image.open(io.BytesIO(img["image_bytes"])) as img_pil:
+                            image = img_pil.convert("RGB")
+                    with open(img["image_path"], "wb") as f:
+                        f.write(img["image_bytes"])
+                    images.append(image)
+                    keys.append(key)
+                    decoded_image_data.append(img)
+                except Exception as e:
+                    logger.warning(f"Failed to process image {img['image_path']}: {str(e)}")
+                finally:
+                    del img["image_bytes"]
+            return images, decoded_image_data, keys
+
+        def cached_images(batch):
+            if embedding_cache is None:
+                return {}
+            return embedding_cache.get_many([embedding_cache.image_key(img["content_hash"]) for img in batch])
+
+        async def store_image_batch(batch):
+            with span("ingest_image_decode"):
+                cached = await loop.run_in_executor(executor, lambda: cached_images(batch))
+                images, decoded_image_data, keys = await loop.run_in_executor(
+                    executor, lambda: decode_and_save(batch, cached)
+                )
+            if not images:
+                return
+            job.progress["images_total"] = stored["images"] + len(images)
+            job.stage = "encoding_images"
+            with span("ingest_encode_images"):
+                embeddings, skipped = await loop.run_in_executor(
+                    executor,
+                    lambda: encode_missing(job, "images_encoded", embedding_cache, keys, siglip_model, siglip_processor,
+                                           images=images, offset=stored["images"], cached=cached)
+                )
+            job.progress["images_cached"] += skipped
+            job.stage = "indexing"
+            with span("ingest_db_insert"):
+                if stored["images"] == 0:
+                    await set_document_image_embedding_path(db, document.id, embedding_path)
+                image_ids = await create_image_metadata(db, document.id, decoded_image_data, offset=stored["images"])
+            for image_id, img in zip(image_ids, decoded_image_data):
+                img["image_id"] = image_id
+                img["stored_pages"] = len(img["pages"])
+            with span("ingest_index_add"):
+                await add_document_to_chatwindow(
+                    state.index_cache, chatwindow_uuid, document.id, [], None, image_ids, embeddings
+                )
+            stored["images"] += len(images)
+            stored["batches"] += 1
+
+        def add_images(image_data):
+            """Queue images not seen earlier in the document; repeats only add their pages."""
+            for img in image_data:
+                known = images_by_hash.get(img["content_hash"])
+                if known is None:
+                    images_by_hash[img["content_hash"]] = img
+                    pending_images.append(img)
+                else:
+                    known["pages"].extend(page for page in img["pages"] if page not in known["pages"])
+                    job.progress["images_deduplicated"] += 1
+
+        try:
+            job.stage = "extracting"
+            logger.info(f"Extracting text and images for chatwindow: {chatwindow_uuid}")
+            waiting_since = time.perf_counter()
+            async for page_texts, image_data, page_count in iter_page_batches(job.pdf_path, chatwindow_uuid, document.id):
+                observe("ingest_extract", time.perf_counter() - waiting_since)
+                job.progress["pages_total"] = page_count
+                job.progress["pages_extracted"] = page_texts[-1][0] if page_texts else job.progress["pages_extracted"]
+                with span("ingest_chunk"):
+                    for page_num, paragraph in paragraphs_of(page_texts):
+                        pending_chunks.extend(chunker.add(page_num, paragraph))
+                add_images(image_data)
+                job.progress["chunks_total"] = stored["chunks"] + len(pending_chunks)
+
+                while len(pending_chunks) >= INGEST_TEXT_BATCH:
+                    batch, pending_chunks = pending_chunks[:INGEST_TEXT_BATCH], pending_chunks[INGEST_TEXT_BATCH:]
+                    await store_text_batch(batch)
+                while len(pending_images) >= INGEST_IMAGE_BATCH:
+                    batch, pending_images = pending_images[:INGEST_IMAGE_BATCH], pending_images[INGEST_IMAGE_BATCH:]
+                    await store_image_batch(batch)
+                job.stage = "extracting"
+                waiting_since = time.perf_counter()
+
+            pending_chunks.extend(chunker.flush())
+            job.progress["chunks_total"] = stored["chunks"] + len(pending_chunks)
+            if pending_chunks:
+                await store_text_batch(pending_chunks)
+            if pending_images:
+                await store_image_batch(pending_images)
+            repeated = {img["image_id"]: img for img in images_by_hash.values()
+                        if "image_id" in img and len(img["pages"]) > img["stored_pages"]}
+            if repeated:
+                await update_image_pages(db, repeated)
+
+            with span("ingest_bm25"):
+                await loop.run_in_executor(
+                    None, lambda: save_document_postings(chatwindow_uuid, document.id, postings[0], postings[1])
+                )
+        except BaseException:
+            # Includes CancelledError from a shutdown, which would otherwise leave the
+            # document's rows and vectors behind.
+            logger.warning(f"Discarding partially ingested document {document.id}")
+            await discard_document(state, db, chatwindow_uuid, document.id)
+            raise
+
+    encodes_skipped = job.progress["chunks_cached"] + job.progress["images_cached"]
+    logger.info(f"Ingested document {document.id}: {stored['chunks']} chunks, {stored['images']} images "
+                f"({job.progress['images_deduplicated']} repeats skipped, {encodes_skipped} encodes reused) "
+                f"in {stored['batches']} batches, chatwindow={chatwindow_uuid}")
+    return {
+        "status": "success",
+        "doc_uuid": document.id,
+        "chunks_added": stored["chunks"],
+        "images_added": stored["images"],
+        "images_deduplicated": job.progress["images_deduplicated"],
+        "encodes_skipped": encodes_skipped,
+    }
+
+class IngestionQueue:
+    """Bounded pool of asyncio workers running ``ingest_pdf`` jobs off the request path.
+
+    ``concurrency`` caps both the number of documents processed at once and the
+    threads used for their SigLIP encodes, so ingestion cannot take over the model
+    threads that serve /search.
+    """
+
+    def __init__(self, app, concurrency: int = INGEST_CONCURRENCY, max_queued: int = INGEST_QUEUE_SIZE,
+                 history: int = INGEST_JOB_HISTORY):
+        self.app = app
+        self.concurrency = concurrency
+        self.history = history
+        self.jobs = OrderedDict()
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._workers = []
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ingest")
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._executor.shutdown(wait=False)
+
+    def submit(self, chatwindow_id: str, filename: str, pdf_path: str) -> IngestionJob:
+        job = IngestionJob(chatwindow_id, filename, pdf_path)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self._trim_history()
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = datetime.now(timezone.utc).isoformat()
+            try:
+                with span("ingest_document"):
+                    job.result = await ingest_pdf(self.app, job, self._executor)
+                job.status = "completed"
+                job.stage = "completed"
+            except asyncio.CancelledError:
+                logger.warning(f"Ingestion job {job.id} cancelled")
+                job.status = "failed"
+                job.error = "Ingestion was cancelled before the PDF was processed"
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion job {job.id} failed: {str(e)}", exc_info=True)
+                job.status = "failed"
+                job.error = f"Failed to process PDF: {str(e)}"
+            finally:
+                job.finished_at = datetime.now(timezone.utc).isoformat()
+                if os.path.exists(job.pdf_path):
+                    os.remove(job.pdf_path)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        statuses = [job.status for job in self.jobs.values()]
+        return {
+            "concurrency": self.concurrency,
+            "queued": self._queue.qsize(),
+            "running": statuses.count("running"),
+            "completed": statuses.count("completed"),
+            "failed": statuses.count("failed"),
+        }
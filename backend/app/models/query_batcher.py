@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+from models.embedding_model import encode_with_siglip
+from utils.lru_cache import LRUCache
+from utils.text_utils import normalize_query
+import asyncio
+import os
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "16"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "10000"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "0")) or None
+QUERY_CACHE_ENTRY_OVERHEAD = 200
+
+def create_query_cache():
+    return LRUCache(
+        max_entries=QUERY_CACHE_MAX_ENTRIES,
+        ttl=QUERY_CACHE_TTL_SECONDS,
+        sizeof=lambda embedding: embedding.nbytes + QUERY_CACHE_ENTRY_OVERHEAD
+    )
+
+class QueryEmbeddingBatcher:
+    """Coalesces concurrent query encodes into single SigLIP text-tower forward passes.
+
+    Callers await ``encode``; a background task collects queued queries for up to
+    ``max_wait_ms`` or ``max_batch_size`` items, encodes them on one dedicated thread
+    and resolves each caller's future with its own ``(1, dim)`` row. Queries are
+    normalized first; normalized queries found in ``cache`` or already in flight
+    are not encoded again. Query embeddings do not depend on the chatwindow, so one
+    cache serves every window.
+    """
+
+    def __init__(self, model, processor, cache=None, max_batch_size: int = QUERY_BATCH_MAX_SIZE, max_wait_ms: float = QUERY_BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.processor = processor
+        self.cache = cache
+        self._in_flight = {}
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="siglip-query")
+        self.batches = 0
+        self.queries = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Query batcher stopped"))
+        self._executor.shutdown(wait=False)
+
+    async def encode(self, text: str):
+        if self._task is None:
+            raise RuntimeError("Query batcher is not running")
+        key = normalize_query(text)
+        if self.cache is not None:
+            embedding = self.cache.get(key)
+            if embedding is not None:
+                return embedding.copy()
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            await self._queue.put((key, future))
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        embedding = await asyncio.shield(future)
+        return embedding.copy()
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return [(text, future) for text, future in batch if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    self._executor,
+                    lambda: encode_with_siglip(self.model, self.processor, texts=texts, batch_size=len(texts))
+                )
+            except Exception as e:
+                logger.error(f"Query batch of {len(texts)} failed: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for i, (text, future) in enumerate(batch):
+                embedding = embeddings[i:i + 1].copy()
+                if self.cache is not None:
+                    self.cache.put(text, embedding)
+                if not future.done():
+                    future.set_result(embedding)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+        }
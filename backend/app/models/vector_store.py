@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+import uuid
+import numpy as np
+import faiss
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VECTOR_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float32")
+COMPACTION_THRESHOLD = float(os.getenv("VECTOR_STORE_COMPACTION_THRESHOLD", "0.25"))
+MANIFEST_NAME = "manifest.json"
+KINDS = ("text", "image")
+# Ids appended to a VectorIdMap are kept in a side table of at most this many before a full re-sort.
+ID_MAP_DELTA_MAX = int(os.getenv("VECTOR_ID_MAP_DELTA_MAX", "8192"))
+VECTOR_ID_MASK = (1 << 63) - 1
+ROW_DTYPE = np.dtype([
+    ("vector_id", "<i8"),
+    ("kind", "u1"),
+    ("row_id", "S36"),
+    ("doc_id", "S36"),
+])
+
+_store_locks = {}
+_store_locks_guard = threading.Lock()
+
+def vector_id(row_id: str) -> int:
+    return uuid.UUID(row_id).int & VECTOR_ID_MASK
+
+def _store_lock(directory: str):
+    with _store_locks_guard:
+        return _store_locks.setdefault(os.path.abspath(directory), threading.Lock())
+
+class VectorIdMap:
+    """Maps FAISS int64 ids back to ``(kind, row_id)`` using sorted numpy columns.
+
+    Lookups are a binary search and never materialize per-row Python objects, so a
+    window opened from its segment files needs no Python loop over its rows. Ids
+    added after the map was built go to a small sorted delta that is merged into
+    the main columns once it outgrows ``ID_MAP_DELTA_MAX``, so appending a batch
+    does not re-sort the whole window.
+    """
+
+    def __init__(self, vector_ids=None, kinds=None, row_ids=None, positions=None):
+        self._base = _empty_columns()
+        self._delta = _empty_columns()
+        # Segment the positions refer to; set by whoever builds the map from a store.
+        self.store = None
+        self.generation = None
+        if vector_ids is not None:
+            self.add(vector_ids, kinds, row_ids, positions)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for part in (self._base, self._delta) for column in part)
+
+    def __len__(self):
+        return len(self._base[0]) + len(self._delta[0])
+
+    def _find(self, vid):
+        for part in (self._base, self._delta):
+            pos = int(np.searchsorted(part[0], vid))
+            if pos < len(part[0]) and part[0][pos] == vid:
+                return part, pos
+        return None, None
+
+    def __contains__(self, vid):
+        return self._find(vid)[0] is not None
+
+    def __getitem__(self, vid):
+        part, pos = self._find(vid)
+        if part is None:
+            raise KeyError(vid)
+        return KINDS[part[1][pos]], part[2][pos].decode()
+
+    def get(self, vid, default=None):
+        part, pos = self._find(vid)
+        if part is None:
+            return default
+        return KINDS[part[1][pos]], part[2][pos].decode()
+
+    def values(self):
+        for part in (self._base, self._delta):
+            for kind, row_id in zip(part[1], part[2]):
+                yield KINDS[kind], row_id.decode()
+
+    def copy(self) -> "VectorIdMap":
+        """Cheap copy for copy-on-write updates; ``add`` and ``remove`` never modify arrays in place."""
+        clone = VectorIdMap()
+        clone._base, clone._delta = self._base, self._delta
+        clone.store, clone.generation = self.store, self.generation
+        return clone
+
+    def segment_positions(self, vector_ids):
+        """Row offsets of ``vector_ids`` in the segment files, ``-1`` where unknown."""
+        vector_ids = np.asarray(vector_ids, dtype="<i8")
+        found = np.full(len(vector_ids), -1, dtype="<i8")
+        for part_ids, _, _, part_positions in (self._base, self._delta):
+            if not len(part_ids):
+                continue
+            pos = np.minimum(np.searchsorted(part_ids, vector_ids), len(part_ids) - 1)
+            found = np.where(part_ids[pos] == vector_ids, part_positions[pos], found)
+        return found
+
+    def add(self, vector_ids, kinds, row_ids, positions=None):
+        if positions is None:
+            positions = np.full(len(vector_ids), -1, dtype="<i8")
+        added = (
+            np.asarray(vector_ids, dtype="<i8"),
+            np.asarray(kinds, dtype="u1"),
+            np.asarray(row_ids, dtype="S36"),
+            np.asarray(positions, dtype="<i8"),
+        )
+        self._delta = _merge_columns(self._delta, added)
+        if len(self._delta[0]) > min(ID_MAP_DELTA_MAX, len(self._base[0])):
+            self._base, self._delta = _merge_columns(self._base, self._delta), _empty_columns()
+
+    def remove(self, vector_ids):
+        vector_ids = np.asarray(vector_ids, dtype="<i8")
+        self._base, self._delta = (
+            tuple(column[~np.isin(part[0], vector_ids)] for column in part) for part in (self._base, self._delta)
+        )
+
+def _empty_columns():
+    return (np.empty(0, dtype="<i8"), np.empty(0, dtype="u1"), np.empty(0, dtype="S36"), np.empty(0, dtype="<i8"))
+
+def _merge_columns(left, right):
+    if not len(right[0]):
+        return left
+    columns = [np.concatenate([a, b]) for a, b in zip(left, right)]
+    order = np.argsort(columns[0], kind="stable")
+    return tuple(column[order] for column in columns)
+
+class VectorSegmentStore:
+    """Append-only per-chatwindow vector segment.
+
+    Normalized vectors live in one contiguous ``vectors.<gen>.bin`` file next to a
+    fixed-width ``rows.<gen>.bin`` table (vector id, kind, row uuid, document uuid);
+    the row offset is the vector offset. Deletes append vector ids to
+    ``tombstones.<gen>.bin`` and compaction rewrites the live rows into a new
+    generation. ``manifest.json`` is replaced atomically and is the only source of
+    truth for how many rows of each file are committed.
+    """
+
+    def __init__(self, directory: str, dimension: int = 1152, dtype: str = VECTOR_DTYPE):
+        self.directory = directory
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self._lock = _store_lock(directory)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def _read_manifest(self) -> dict:
+        if not self.exists():
+            return {
+                "dimension": self.dimension,
+                "dtype": self.dtype.name,
+                "generation": 0,
+                "count": 0,
+                "tombstones": 0,
+                "version": 0,
+            }
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def _path(self, name: str, generation: int) -> str:
+        return os.path.join(self.directory, f"{name}.{generation}.bin")
+
+    @staticmethod
+    def _append(path: str, committed_bytes: int, data: bytes):
+        mode = "r+b" if os.path.exists(path) else "wb"
+        with open(path, mode) as f:
+            f.truncate(committed_bytes)
+            f.seek(committed_bytes)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def version(self) -> int:
+        return self._read_manifest()["version"]
+
+    def append(self, doc_id: str, kind: str, row_ids: list[str], embeddings):
+        """Normalize and append vectors for ``row_ids``; returns ``(vectors, rows, positions)``."""
+        if len(row_ids) != len(embeddings):
+            raise ValueError(f"Got {len(embeddings)} {kind} embeddings for {len(row_ids)} rows")
+        embeddings = np.array(embeddings, dtype="float32")
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dimension:
+            raise ValueError(f"Embedding dimension {embeddings.shape[-1]} does not match store dimension {self.dimension}")
+        faiss.normalize_L2(embeddings)
+
+        rows = np.empty(len(row_ids), dtype=ROW_DTYPE)
+        rows["vector_id"] = [vector_id(row_id) for row_id in row_ids]
+        rows["kind"] = KINDS.index(kind)
+        rows["row_id"] = row_ids
+        rows["doc_id"] = doc_id
+        if not len(rows):
+            return embeddings, rows, np.empty(0, dtype="<i8")
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            manifest = self._read_manifest()
+            dtype = np.dtype(manifest["dtype"])
+            generation, count = manifest["generation"], manifest["count"]
+            self._append(self._path("vectors", generation), count * self.dimension * dtype.itemsize,
+                         embeddings.astype(dtype).tobytes())
+            self._append(self._path("rows", generation), count * ROW_DTYPE.itemsize, rows.tobytes())
+            manifest["count"] = count + len(rows)
+            manifest["version"] += 1
+            self._write_manifest(manifest)
+        logger.info(f"Appended {len(rows)} {kind} vectors to segment {self.directory}, count={manifest['count']}")
+        return embeddings, rows, np.arange(count, count + len(rows), dtype="<i8")
+
+    def _open_rows(self, manifest: dict):
+        count = manifest["count"]
+        if not count:
+            return np.empty(0, dtype=ROW_DTYPE)
+        return np.memmap(self._path("rows", manifest["generation"]), dtype=ROW_DTYPE, mode="r", shape=(count,))
+
+    def _open_vectors(self, manifest: dict):
+        count = manifest["count"]
+        if not count:
+            return np.empty((0, self.dimension), dtype=manifest["dtype"])
+        return np.memmap(self._path("vectors", manifest["generation"]), dtype=manifest["dtype"], mode="r",
+                         shape=(count, manifest["dimension"]))
+
+    def _tombstoned(self, manifest: dict):
+        if not manifest["tombstones"]:
+            return np.empty(0, dtype="<i8")
+        return np.fromfile(self._path("tombstones", manifest["generation"]), dtype="<i8", count=manifest["tombstones"])
+
+    def tombstone(self, doc_id: str):
+        """Mark every vector of ``doc_id`` deleted; returns the tombstoned vector ids."""
+        with self._lock:
+            if not self.exists():
+                return np.empty(0, dtype="<i8")
+            manifest = self._read_manifest()
+            rows = self._open_rows(manifest)
+            doc_ids = doc_id.encode()
+            vector_ids = np.asarray(rows["vector_id"][rows["doc_id"] == doc_ids])
+            vector_ids = vector_ids[~np.isin(vector_ids, self._tombstoned(manifest))]
+            if len(vector_ids):
+                path = self._path("tombstones", manifest["generation"])
+                self._append(path, manifest["tombstones"] * 8, vector_ids.astype("<i8").tobytes())
+                manifest["tombstones"] += len(vector_ids)
+                manifest["version"] += 1
+                self._write_manifest(manifest)
+        logger.info(f"Tombstoned {len(vector_ids)} vectors of document {doc_id} in segment {self.directory}")
+        return vector_ids
+
+    def generation(self) -> int:
+        return self._read_manifest()["generation"]
+
+    def read(self):
+        """Return ``(vectors, rows, positions)`` for live rows; vectors are float32 and L2-normalized."""
+        manifest = self._read_manifest()
+        vectors = self._open_vectors(manifest)
+        rows = self._open_rows(manifest)
+        positions = np.arange(len(rows), dtype="<i8")
+        tombstoned = self._tombstoned(manifest)
+        if len(tombstoned):
+            alive = ~np.isin(rows["vector_id"], tombstoned)
+            vectors = vectors[alive]
+            rows = rows[alive]
+            positions = positions[alive]
+        return np.ascontiguousarray(vectors, dtype="float32"), rows, positions
+
+    def gather(self, positions, generation: int):
+        """Read the vectors at row ``positions`` as float32, or ``None`` if ``generation`` was compacted away."""
+        manifest = self._read_manifest()
+        if manifest["generation"] != generation:
+            return None
+        positions = np.asarray(positions, dtype="<i8")
+        return np.asarray(self._open_vectors(manifest)[positions], dtype="float32")
+
+    def needs_compaction(self) -> bool:
+        manifest = self._read_manifest()
+        return manifest["count"] > 0 and manifest["tombstones"] / manifest["count"] >= COMPACTION_THRESHOLD
+
+    def compact(self):
+        """Rewrite live rows into a new generation and drop the old files."""
+        with self._lock:
+            if not self.exists():
+                return
+            manifest = self._read_manifest()
+            old_generation = manifest["generation"]
+            rows = self._open_rows(manifest)
+            vectors = self._open_vectors(manifest)
+            tombstoned = self._tombstoned(manifest)
+            alive = ~np.isin(rows["vector_id"], tombstoned)
+            generation = old_generation + 1
+            np.ascontiguousarray(vectors[alive]).tofile(self._path("vectors", generation))
+            np.ascontiguousarray(rows[alive]).tofile(self._path("rows", generation))
+            del rows, vectors
+            manifest.update(generation=generation, count=int(alive.sum()), tombstones=0)
+            self._write_manifest(manifest)
+            for name in ("vectors", "rows", "tombstones"):
+                path = self._path(name, old_generation)
+                if os.path.exists(path):
+                    os.remove(path)
+        logger.info(f"Compacted segment {self.directory}: {manifest['count']} live rows, generation {generation}")
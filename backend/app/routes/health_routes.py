@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+def require_ready(request: Request):
+    """Route dependency that turns requests away with 503 until the models they need are loaded."""
+    if not request.app.state.readiness.ready:
+        raise HTTPException(status_code=503, detail="Service is starting, models are not loaded yet",
+                            headers={"Retry-After": "5"})
+
+@router.get("/health/live")
+async def liveness(request: Request):
+    readiness = request.app.state.readiness
+    if readiness.failed:
+        return JSONResponse(status_code=503, content={"status": "failed", **readiness.snapshot()})
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+async def readiness_check(request: Request):
+    snapshot = request.app.state.readiness.snapshot()
+    snapshot["generation_ready"] = request.app.state.llm.loaded
+    if not snapshot["ready"]:
+        return JSONResponse(status_code=503, content=snapshot)
+    return snapshot
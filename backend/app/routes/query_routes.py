@@ -1,151 +1,260 @@
 from fastapi import APIRouter, Request, HTTPException, Depends
-from schemas.query_schema import QueryRequest
-from models.faiss_manager import search_embeddings
-from models.embedding_model import generate_tailored_response, encode_with_siglip
-from models.database import get_db
-from models.db_models import Document, TextChunk, ImageMetadata
+from fastapi.responses import StreamingResponse
+from schemas.query_schema import QueryRequest, AnswerRequest
+from models.faiss_manager import get_chatwindow_data, search_embeddings, chatwindow_version
+from models.answer_cache import AnswerCache
+from models.bm25_index import get_chatwindow_bm25, reciprocal_rank_fusion, tokenize
+from models.embedding_model import trim_incomplete_sentence, LLM_CONTEXT_CHUNKS
+from models.database import get_db, run_in_session
+from models.db_manager import get_text_chunks_by_ids, get_image_metadata_by_ids, get_neighbouring_chunks
+from models.context_packer import widen_context, LLM_CONTEXT_RADIUS, LLM_CONTEXT_TOKEN_BUDGET
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
-import numpy as np
-import asyncio
+from utils.metrics import span
+from contextlib import aclosing
 from datetime import datetime, timezone
-from rank_bm25 import BM25Okapi
-from nltk.tokenize import word_tokenize
+import asyncio
+import json
+import os
+import random
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Share of searches whose per-hit details are logged at INFO; DEBUG logging shows them all.
+SEARCH_LOG_SAMPLE_RATE = float(os.getenv("SEARCH_LOG_SAMPLE_RATE", "0"))
+
 router = APIRouter()
 
-@router.post("/search")
-async def search_query(request: Request, query: QueryRequest, images: bool = True, db: AsyncSession = Depends(get_db)):
-    if not hasattr(request.app.state, 'current_chatwindow') or not request.app.state.current_chatwindow:
+def resolve_chatwindow(request: Request, chatwindow_uuid: str = None) -> str:
+    """Use the window named in the request, falling back to the one picked with /select-chatwindow."""
+    if chatwindow_uuid:
+        return chatwindow_uuid
+    if not getattr(request.app.state, 'current_chatwindow', None):
         raise HTTPException(status_code=400, detail="No chatwindow selected")
-    chatwindow_uuid = request.app.state.current_chatwindow
-    logger.info(f"Searching in chatwindow: {chatwindow_uuid}, images_enabled={images}")
-    try:
-        siglip_model = request.app.state.siglip_model
-        siglip_processor = request.app.state.siglip_processor
-        llm_model = request.app.state.llm_model
-        llm_tokenizer = request.app.state.llm_tokenizer
-        loop = asyncio.get_event_loop()
-
-        start_time = datetime.now(timezone.utc).isoformat()
-
-        logger.info(f"Encoding query: {query.query}")
-        query_embedding = await loop.run_in_executor(
-            None,
-            lambda: encode_with_siglip(siglip_model, siglip_processor, texts=[query.query])
+    return request.app.state.current_chatwindow
+
+async def retrieve_results(request: Request, query: QueryRequest, images: bool, db: AsyncSession, chatwindow_uuid: str):
+    """Retrieval half of /search; returns the response body without an answer and the retrieved chunk rows."""
+    start_time = datetime.now(timezone.utc).isoformat()
+    verbose = logger.isEnabledFor(logging.DEBUG) or random.random() < SEARCH_LOG_SAMPLE_RATE
+
+    with span("query_encode"):
+        query_np = await request.app.state.query_batcher.encode(query.query)
+
+    with span("index_load"):
+        index, all_ids = await get_chatwindow_data(request.app.state.index_cache, db, chatwindow_uuid)
+    if index.ntotal == 0 or not all_ids:
+        raise HTTPException(status_code=400, detail="No embeddings available for this chatwindow.")
+
+    search_k = max(query.top_k, 10) if images else query.top_k
+    loop = asyncio.get_event_loop()
+    with span("faiss_search"):
+        scores, indices = await loop.run_in_executor(
+            None, lambda: search_embeddings(index, query_np, top_k=search_k, all_ids=all_ids)
         )
-        query_np = np.array(query_embedding, dtype='float32')
-        logger.info(f"Query embedding shape: {query_np.shape}")
-
-        index = request.app.state.index
-        if index is None or index.ntotal == 0:
-            raise HTTPException(status_code=400, detail="No chatwindow selected or no embeddings available.")
-
-        search_k = max(query.top_k, 10) if images else query.top_k
-        scores, indices = search_embeddings(index, query_np, top_k=search_k)
-        logger.info(f"FAISS search returned {len(indices[0])} indices")
-
-        if not hasattr(request.app.state, 'all_ids'):
-            raise HTTPException(status_code=500, detail="Application state missing all_ids attribute")
-        all_ids = request.app.state.all_ids
-        if not all_ids:
-            raise HTTPException(status_code=400, detail="No IDs available for the current chatwindow.")
-        logger.info(f"Total all_ids count: {len(all_ids)}, types: {[t for t, _ in all_ids]}")
-
-        text_results = []
-        image_results = []
-        text_chunks = []
-
-        text_ids = []
-        image_ids = []
-        for i, idx in enumerate(indices[0]):
-            if idx == -1 or idx >= len(all_ids):
-                logger.warning(f"Invalid index {idx} in FAISS results")
-                continue
-            type, id = all_ids[idx]
+
+    text_results = []
+    image_results = []
+    context_rows = []
+
+    vector_scores = {}
+    image_ids = []
+    for i, idx in enumerate(indices[0]):
+        if idx == -1:
+            continue
+        entry = all_ids.get(idx)
+        if entry is None:
+            logger.debug(f"Skipping FAISS id {idx} missing from the id map of chatwindow {chatwindow_uuid}")
+            continue
+        type, id = entry
+        if verbose:
             logger.info(f"FAISS index {idx}: type={type}, id={id}, score={scores[0][i]}")
-            if type == 'text':
-                text_ids.append((id, i, scores[0][i]))
-            elif type == 'image' and images:
-                image_ids.append((id, i, scores[0][i]))
-
-        logger.info(f"Text IDs: {len(text_ids)}, Image IDs: {len(image_ids)}")
-
-        text_ids = text_ids[:query.top_k]
-
-        if image_ids and images:
-            image_ids = sorted(image_ids, key=lambda x: x[2], reverse=True)[:1]
-            logger.info(f"Selected top 1 image ID: {image_ids}")
-
-        if text_ids:
-            text_ids_only = [id for id, _, _ in text_ids]
-            logger.info(f"Fetching {len(text_ids)} text chunks from database")
-            text_query = select(TextChunk).filter(TextChunk.id.in_(text_ids_only)).options(selectinload(TextChunk.document))
-            text_result = await db.execute(text_query)
-            text_chunks_db = {chunk.id: chunk for chunk in text_result.scalars().all()}
-            for id, i, score in text_ids:
-                chunk = text_chunks_db.get(id)
-                if chunk:
-                    text_results.append({
-                        "text": chunk.chunk,
-                        "page_number": chunk.page_number,
-                        "pdf_name": chunk.document.name,
-                        "vector_score": float(score),
-                        "chunk_id": chunk.id
-                    })
-                    text_chunks.append(chunk.chunk)
-
-        if image_ids and images:
-            image_ids_only = [id for id, _, _ in image_ids]
-            logger.info(f"Fetching {len(image_ids)} image metadata from database")
-            image_query = select(ImageMetadata).filter(ImageMetadata.id.in_(image_ids_only)).options(selectinload(ImageMetadata.document))
-            image_result = await db.execute(image_query)
-            image_metadata_db = {image.id: image for image in image_result.scalars().all()}
-            for id, i, score in image_ids:
-                image = image_metadata_db.get(id)
-                if image:
-                    image_results.append({
-                        "image_path": image.image_path,
-                        "metadata": image.meta_data,
-                        "pdf_name": image.document.name,
-                        "score": float(score)
-                    })
-
-        if text_results:
-            tokenized_chunks = [word_tokenize(chunk["text"].lower()) for chunk in text_results]
-            bm25 = BM25Okapi(tokenized_chunks)
-            tokenized_query = word_tokenize(query.query.lower())
-            bm25_scores = bm25.get_scores(tokenized_query)
-
-            for i, result in enumerate(text_results):
-                bm25_score = bm25_scores[i]
-                result["bm25_score"] = bm25_score
-                result["score"] = result["vector_score"] + bm25_score
-
-            text_results = sorted(text_results, key=lambda x: x["score"], reverse=True)
-
-        logger.info(f"Generating tailored response for {len(text_chunks)} chunks")
-        tailored_response = await generate_tailored_response(
-            llm_model, llm_tokenizer, query.query, text_chunks, max_length=200
+        if type == 'text':
+            vector_scores[id] = float(scores[0][i])
+        elif type == 'image' and images:
+            image_ids.append((id, i, scores[0][i]))
+
+    with span("bm25_search"):
+        bm25_index = await get_chatwindow_bm25(request.app.state.bm25_cache, db, chatwindow_uuid)
+        bm25_hits = await loop.run_in_executor(None, lambda: bm25_index.search(tokenize(query.query), top_k=search_k))
+        bm25_scores = {}
+        for vid, bm25_score in bm25_hits:
+            entry = all_ids.get(vid)
+            if entry is not None and entry[0] == 'text':
+                bm25_scores[entry[1]] = bm25_score
+
+    fused_scores = reciprocal_rank_fusion([list(vector_scores), list(bm25_scores)])
+    text_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:query.top_k]
+    if verbose:
+        logger.info(f"Text IDs: {len(text_ids)} (vector={len(vector_scores)}, bm25={len(bm25_scores)}), Image IDs: {len(image_ids)}")
+
+    if image_ids and images:
+        image_ids = sorted(image_ids, key=lambda x: x[2], reverse=True)[:1]
+
+    image_ids_only = [id for id, _, _ in image_ids]
+    with span("db_fetch"):
+        text_chunks_db, image_metadata_db = await asyncio.gather(
+            run_in_session(get_text_chunks_by_ids, text_ids),
+            run_in_session(get_image_metadata_by_ids, image_ids_only)
         )
 
-        response = {
-            "query": query.query,
-            "started_at": start_time,
-            "text_results": text_results,
-            "tailored_response": tailored_response
-        }
-        if images:
-            response["image_results"] = image_results
+    for id in text_ids:
+        chunk = text_chunks_db.get(id)
+        if chunk:
+            text_results.append({
+                "text": chunk.chunk,
+                "page_number": chunk.page_number,
+                "pdf_name": chunk.document.name,
+                "vector_score": vector_scores.get(id),
+                "bm25_score": bm25_scores.get(id),
+                "score": fused_scores[id],
+                "chunk_id": chunk.id
+            })
+            context_rows.append(chunk)
+
+    for id, i, score in image_ids:
+        image = image_metadata_db.get(id)
+        if image:
+            image_results.append({
+                "image_path": image.image_path,
+                "metadata": image.meta_data,
+                "pdf_name": image.document.name,
+                "score": float(score)
+            })
+
+    response = {
+        "query": query.query,
+        "started_at": start_time,
+        "text_results": text_results
+    }
+    if images:
+        response["image_results"] = image_results
+    request.app.state.readiness.record_retrieval()
+    if verbose:
+        logger.info(f"Retrieval completed, text_results={len(text_results)}, image_results={len(image_results)}")
+    return response, context_rows
+
+async def answer_cache_key(chatwindow_uuid: str, query: str, chunk_ids: list[str]) -> str:
+    version = await chatwindow_version(chatwindow_uuid)
+    return AnswerCache.key(chatwindow_uuid, version, query, chunk_ids[:LLM_CONTEXT_CHUNKS])
+
+async def cached_answer(answer_cache: AnswerCache, answer_key: str):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: answer_cache.get(answer_key))
+
+async def store_answer(answer_cache: AnswerCache, answer_key: str, answer: str):
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, lambda: answer_cache.put(answer_key, answer))
+
+async def generation_context(chunks: list) -> list[str]:
+    """Passages for the answer prompt: the best-ranked chunks, widened with their neighbours to the token budget."""
+    chunks = chunks[:LLM_CONTEXT_CHUNKS]
+    if not LLM_CONTEXT_TOKEN_BUDGET:
+        return [chunk.chunk for chunk in chunks]
+    with span("context_widen"):
+        neighbours = await run_in_session(get_neighbouring_chunks, chunks, LLM_CONTEXT_RADIUS)
+        return widen_context(chunks, neighbours)
+
+async def cached_tailored_response(request: Request, chatwindow_uuid: str, query: str, chunk_ids: list[str], chunks: list) -> str:
+    answer_cache = request.app.state.answer_cache
+    answer_key = await answer_cache_key(chatwindow_uuid, query, chunk_ids)
+    tailored_response = await cached_answer(answer_cache, answer_key)
+    if tailored_response is not None:
+        logger.info("Serving tailored response from answer cache")
+        return tailored_response
+    logger.info(f"Generating tailored response for {len(chunks)} chunks")
+    context = await generation_context(chunks)
+    scheduler = await request.app.state.llm.get()
+    with span("llm_generate"):
+        tailored_response = await scheduler.generate(query, context)
+    await store_answer(answer_cache, answer_key, tailored_response)
+    return tailored_response
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/search")
+async def search_query(request: Request, query: QueryRequest, images: bool = True, generate: bool = True, db: AsyncSession = Depends(get_db)):
+    chatwindow_uuid = resolve_chatwindow(request, query.chatwindow_uuid)
+    logger.info(f"Searching in chatwindow: {chatwindow_uuid}, images_enabled={images}, generate={generate}")
+    try:
+        response, context_rows = await retrieve_results(request, query, images, db, chatwindow_uuid)
+        if generate:
+            context_ids = [result["chunk_id"] for result in response["text_results"]]
+            response["tailored_response"] = await cached_tailored_response(
+                request, chatwindow_uuid, query.query, context_ids, context_rows
+            )
 
-        logger.info(f"Search completed successfully, text_results={len(text_results)}, image_results={len(image_results)}")
         return response
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Search failed: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+@router.post("/search/stream")
+async def search_query_stream(request: Request, query: QueryRequest, images: bool = True, db: AsyncSession = Depends(get_db)):
+    chatwindow_uuid = resolve_chatwindow(request, query.chatwindow_uuid)
+    logger.info(f"Streaming search in chatwindow: {chatwindow_uuid}, images_enabled={images}")
+    try:
+        response, context_rows = await retrieve_results(request, query, images, db, chatwindow_uuid)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Search failed: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+    answer_cache = request.app.state.answer_cache
+    answer_key = await answer_cache_key(chatwindow_uuid, query.query, [result["chunk_id"] for result in response["text_results"]])
+
+    async def events():
+        yield sse_event("results", response)
+        cached_response = await cached_answer(answer_cache, answer_key)
+        if cached_response is not None:
+            yield sse_event("done", {"tailored_response": cached_response, "cached": True})
+            return
+        pieces = []
+        try:
+            context = await generation_context(context_rows)
+            scheduler = await request.app.state.llm.get()
+            async with aclosing(scheduler.stream(query.query, context)) as stream:
+                async for piece in stream:
+                    if await request.is_disconnected():
+                        logger.info("Client disconnected, cancelling generation")
+                        return
+                    pieces.append(piece)
+                    yield sse_event("token", {"text": piece})
+            tailored_response = trim_incomplete_sentence("".join(pieces))
+            await store_answer(answer_cache, answer_key, tailored_response)
+            yield sse_event("done", {"tailored_response": tailored_response, "cached": False})
+        except Exception as e:
+            logger.error(f"Streaming generation failed: {str(e)}", exc_info=True)
+            yield sse_event("error", {"detail": f"Generation failed: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/answer")
+async def answer_query(request: Request, answer: AnswerRequest):
+    chatwindow_uuid = resolve_chatwindow(request, answer.chatwindow_uuid)
+    logger.info(f"Answering from {len(answer.chunk_ids)} chunks in chatwindow: {chatwindow_uuid}")
+    try:
+        chunk_ids = answer.chunk_ids[:LLM_CONTEXT_CHUNKS]
+        chunks_db = await run_in_session(get_text_chunks_by_ids, chunk_ids, chatwindow_uuid)
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in chunks_db]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Text chunks not found in this chatwindow: {missing}")
+        chunks = [chunks_db[chunk_id] for chunk_id in chunk_ids]
+        tailored_response = await cached_tailored_response(request, chatwindow_uuid, answer.query, chunk_ids, chunks)
+        return {"query": answer.query, "chunk_ids": chunk_ids, "tailored_response": tailored_response}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Answer failed: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Answer failed: {str(e)}")
@@ -0,0 +1,28 @@
+from fastapi import APIRouter, Request, Response
+from utils.metrics import render_metrics
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.get("/stats")
+async def get_stats(request: Request):
+    state = request.app.state
+    return {
+        "readiness": state.readiness.snapshot(),
+        "index_cache": request.app.state.index_cache.stats(),
+        "bm25_cache": request.app.state.bm25_cache.stats(),
+        "query_batcher": state.query_batcher.stats() if state.query_batcher else None,
+        "query_cache": state.query_cache.stats() if state.query_cache else None,
+        "answer_cache": request.app.state.answer_cache.stats(),
+        "embedding_cache": request.app.state.embedding_cache.stats() if request.app.state.embedding_cache else None,
+        "generation": state.llm.scheduler.stats() if state.llm.scheduler else None,
+        "ingestion": state.ingestion_queue.stats() if state.ingestion_queue else None
+    }
+
+@router.get("/metrics")
+async def get_metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from models.db_manager import (
     delete_document as db_delete_document,
@@ -8,7 +8,12 @@ from models.db_manager import (
     update_chatwindow_title,
     get_documents_by_chatwindow,
 )
-from models.faiss_manager import load_chatwindow_data, init_faiss
+from models.faiss_manager import (
+    get_chatwindow_data,
+    remove_document_from_chatwindow,
+    compact_chatwindow,
+)
+from models.bm25_index import remove_document_from_bm25
 from models.database import get_db
 from schemas.query_schema import TitleUpdateRequest
 import logging
@@ -28,11 +33,9 @@ async def get_all_chat(db: AsyncSession = Depends(get_db)):
 @router.post("/select-chatwindow")
 async def select_chatwindow(request: Request, chatwindow_uuid: str, db: AsyncSession = Depends(get_db)):
     logger.info(f"Selecting chatwindow: {chatwindow_uuid}")
-    index, all_ids = await load_chatwindow_data(db, chatwindow_uuid)
+    index, all_ids = await get_chatwindow_data(request.app.state.index_cache, db, chatwindow_uuid)
     request.app.state.current_chatwindow = chatwindow_uuid
-    request.app.state.index = index
-    request.app.state.all_ids = all_ids
-    logger.info(f"Updated state: chatwindow={chatwindow_uuid}, index_size={index.ntotal}, all_ids_count={len(all_ids)}")
+    logger.info(f"Selected chatwindow={chatwindow_uuid}, index_size={index.ntotal}, all_ids_count={len(all_ids)}")
 
     documents = await get_documents_by_chatwindow(db, chatwindow_uuid)
     logger.info(f"Found {len(documents)} documents for chatwindow: {chatwindow_uuid}")
@@ -59,23 +62,17 @@ async def update_title(chatwindow_uuid: str, request: TitleUpdateRequest, db: As
     return {"message": "Title updated successfully", "chatwindow_uuid": chatwindow_uuid, "title": request.title}
 
 @router.delete("/delete-doc")
-async def delete_pdf(request: Request, chatwindow_uuid: str, doc_uuid: str, db: AsyncSession = Depends(get_db)):
+async def delete_pdf(request: Request, background_tasks: BackgroundTasks, chatwindow_uuid: str, doc_uuid: str, db: AsyncSession = Depends(get_db)):
     logger.info(f"Deleting document {doc_uuid} from chatwindow: {chatwindow_uuid}")
     success = await db_delete_document(db, chatwindow_uuid, doc_uuid)
     if not success:
         logger.error(f"Document not found: {doc_uuid}")
         raise HTTPException(status_code=404, detail="Document not found")
 
-    from models.faiss_manager import delete_document
-    delete_document(chatwindow_uuid, doc_uuid)
-    logger.info(f"Deleted embedding files for document: {doc_uuid}")
-
-    if getattr(request.app.state, "current_chatwindow", None) == chatwindow_uuid:
-        logger.info(f"Reloading data for current chatwindow: {chatwindow_uuid}")
-        index, all_ids = await load_chatwindow_data(db, chatwindow_uuid)
-        request.app.state.index = index
-        request.app.state.all_ids = all_ids
-        logger.info(f"Updated state after deletion: index_size={index.ntotal}, all_ids_count={len(all_ids)}")
+    vector_ids = await remove_document_from_chatwindow(request.app.state.index_cache, chatwindow_uuid, doc_uuid)
+    logger.info(f"Tombstoned {len(vector_ids)} vectors for document: {doc_uuid}")
+    remove_document_from_bm25(request.app.state.bm25_cache, chatwindow_uuid, doc_uuid)
+    background_tasks.add_task(compact_chatwindow, request.app.state.index_cache, chatwindow_uuid)
 
     return {"status": "deleted", "doc_uuid": doc_uuid}
 
@@ -90,11 +87,11 @@ async def delete_chatwindow_route(request: Request, chatwindow_uuid: str, db: As
     from models.faiss_manager import delete_chatwindow
     delete_chatwindow(chatwindow_uuid)
     logger.info(f"Deleted embedding files for chatwindow: {chatwindow_uuid}")
+    request.app.state.index_cache.invalidate(chatwindow_uuid)
+    request.app.state.bm25_cache.invalidate(chatwindow_uuid)
 
     if getattr(request.app.state, "current_chatwindow", None) == chatwindow_uuid:
         logger.info(f"Clearing state for deleted chatwindow: {chatwindow_uuid}")
-        request.app.state.index = init_faiss(dimension=1152)
-        request.app.state.all_ids = []
         request.app.state.current_chatwindow = None
 
     return {"status": "chatwindow deleted", "chatwindow_uuid": chatwindow_uuid}
\ No newline at end of file
@@ -1,8 +1,15 @@
 from pydantic import BaseModel
+from typing import Optional
 
 class QueryRequest(BaseModel):
     query: str
     top_k: int = 3
+    chatwindow_uuid: Optional[str] = None
+
+class AnswerRequest(BaseModel):
+    query: str
+    chunk_ids: list[str]
+    chatwindow_uuid: Optional[str] = None
 
 class TitleUpdateRequest(BaseModel):
     title: str
\ No newline at end of file
@@ -0,0 +1,13 @@
+from models.bm25_index import BM25Index
+
+def test_small_window_scores_every_query_term():
+    index = BM25Index()
+    index.add_document("doc", [1, 2], [
+        {"faiss": 2, "index": 1, "training": 1},
+        {"faiss": 1, "index": 3, "search": 1},
+    ])
+
+    # Both terms occur in every chunk; a two-chunk window must still score them all.
+    assert sorted(index.query_terms(["the", "faiss", "index"])) == ["faiss", "index"]
+    assert [vid for vid, _ in index.search(["index"])] == [2, 1]
+    assert [vid for vid, _ in index.search(["faiss"])] == [1, 2]
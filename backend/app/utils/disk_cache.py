@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+import time
+import os
+
+class DiskCache:
+    """Bounded key/value store in a local SQLite file, evicting least recently used keys."""
+
+    def __init__(self, path: str, max_entries: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self.evictions = 0
+        # Kept up to date by put_many so writes never need a COUNT(*) over the table.
+        self._size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def get_many(self, keys: list[str]) -> dict:
+        if not keys:
+            return {}
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(f"SELECT key, value FROM cache WHERE key IN ({placeholders})", batch).fetchall()
+                found.update(rows)
+                self._conn.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?", [(time.time(), key) for key, _ in rows])
+        return found
+
+    def put(self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    def put_many(self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        keys = list(items)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                existing = 0
+                for start in range(0, len(keys), 500):
+                    batch = keys[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    existing += self._conn.execute(
+                        f"SELECT COUNT(*) FROM cache WHERE key IN ({placeholders})", batch
+                    ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO cache (key, value, accessed_at) VALUES (?, ?, ?)",
+                    [(key, value, now) for key, value in items.items()]
+                )
+                size = self._size + len(keys) - existing
+                overflow = size - self.max_entries
+                if overflow > 0:
+                    size -= self._conn.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (overflow,)
+                    ).rowcount
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._size = size
+            if overflow > 0:
+                self.evictions += overflow
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import time
+
+class LRUCache:
+    """Bounded least-recently-used cache with optional byte budget and TTL.
+
+    ``sizeof`` is called once per stored value to account for its memory; entries
+    are evicted from the cold end until both ``max_entries`` and ``max_bytes`` hold.
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl: float = None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, size, stored_at = entry
+        if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        entry = self._lookup(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value) -> bool:
+        size = self.sizeof(value)
+        if key in self._entries:
+            self._remove(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        self._entries[key] = (value, size, time.monotonic())
+        self.current_bytes += size
+        self._evict()
+        return True
+
+    def invalidate(self, key) -> bool:
+        if key in self._entries:
+            self._remove(key)
+            self.invalidations += 1
+            return True
+        return False
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def _evict(self):
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.current_bytes > self.max_bytes)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,71 @@
+from prometheus_client import Histogram, CONTENT_TYPE_LATEST, generate_latest
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "neosearch_stage_seconds",
+    "Time spent in each stage of search, generation and ingestion",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+# Spans of the HTTP request being handled, for its Server-Timing header; None outside requests.
+_request_timings = ContextVar("request_timings", default=None)
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def span(stage: str):
+    """Time the enclosed block as ``stage``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+def server_timing(timings) -> str:
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items())
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+class TimingMiddleware:
+    """Collects the spans recorded while handling a request into a ``Server-Timing`` header.
+
+    Only spans finished before the response starts are included, so a streamed
+    answer reports its retrieval stages but not generation; those still reach
+    the histograms.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = []
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                timings.append(("total", time.perf_counter() - started))
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
@@ -0,0 +1,63 @@
+import time
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class Readiness:
+    """Load state of the components the server needs, for the health endpoints and startup logs.
+
+    Each component is ``loading``, ``ready`` or ``failed``. The server is ready once
+    every component in ``required`` is ready, and dead once any of them has failed.
+    """
+
+    def __init__(self, required=()):
+        self.started_at = time.monotonic()
+        self.required = tuple(required)
+        self.components = {}
+        self.first_retrieval_seconds = None
+
+    def _set(self, name: str, status: str, started: float, error: str = None):
+        self.components[name] = {
+            "status": status,
+            "seconds": round(time.monotonic() - started, 3),
+            "error": error,
+        }
+
+    async def track(self, name: str, awaitable):
+        """Await ``awaitable`` while reporting ``name`` as loading, then as ready or failed."""
+        started = time.monotonic()
+        self.components[name] = {"status": "loading", "seconds": None, "error": None}
+        try:
+            result = await awaitable
+        except BaseException as e:
+            self._set(name, "failed", started, str(e) or type(e).__name__)
+            logger.error(f"Failed to load {name} after {self.components[name]['seconds']}s: {str(e)}")
+            raise
+        self._set(name, "ready", started)
+        logger.info(f"Loaded {name} in {self.components[name]['seconds']}s")
+        return result
+
+    def status(self, name: str) -> str:
+        return self.components.get(name, {}).get("status", "not_loaded")
+
+    @property
+    def ready(self) -> bool:
+        return all(self.status(name) == "ready" for name in self.required)
+
+    @property
+    def failed(self) -> bool:
+        return any(self.status(name) == "failed" for name in self.required)
+
+    def record_retrieval(self):
+        if self.first_retrieval_seconds is None:
+            self.first_retrieval_seconds = round(time.monotonic() - self.started_at, 3)
+            logger.info(f"First retrieval served {self.first_retrieval_seconds}s after startup")
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 3),
+            "first_retrieval_seconds": self.first_retrieval_seconds,
+            "components": dict(self.components),
+        }
@@ -1,90 +1,309 @@
 import fitz
 import re
 import asyncio
+import collections
+import hashlib
+import multiprocessing
 import os
-from PIL import Image
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-async def extract_and_clean_text(pdf_path: str, chatwindow_id: str, document_id: str) -> tuple[list[tuple[int, str]], list[dict]]:
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACT_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACT_PARALLEL_MIN_PAGES", "32"))
+EXTRACT_PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", "16"))
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "64"))
+IMAGE_MAX_ASPECT_RATIO = float(os.getenv("IMAGE_MAX_ASPECT_RATIO", "8"))
+# "tokens" sizes chunks by the embedding model's tokenizer so every token of a chunk is
+# embedded; "words" is the original 400-word splitter.
+CHUNKER = os.getenv("CHUNKER", "tokens")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "16"))
+
+MARKUP_PATTERN = re.compile(r'```[\s\S]*?```|\{[^{}]*\}|<[^<>]*>|`[^`]*`')
+VERSION_PATTERN = re.compile(r'\b\d+\.\d+\.\d+[\w.-]*\b')
+PATH_PATTERN = re.compile(r'(\.?/)?[\w/-]+/[\w/-]+(\.[\w]+)?')
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s.,!?]|[.,!?]{2,}')
+SPACES_PATTERN = re.compile(r'[ \t]+')
+BLANK_LINES_PATTERN = re.compile(r'(\n\s*)+\n')
+
+_process_pool = None
+
+def normalize_query(query: str) -> str:
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+def clean_text(text: str) -> str:
+    cleaned = MARKUP_PATTERN.sub(' ', text)
+    cleaned = VERSION_PATTERN.sub(' ', cleaned)
+    cleaned = PATH_PATTERN.sub(' ', cleaned)
+    cleaned = PUNCTUATION_PATTERN.sub(' ', cleaned)
+    cleaned = SPACES_PATTERN.sub(' ', cleaned)
+    cleaned = BLANK_LINES_PATTERN.sub('\n\n', cleaned)
+    return cleaned.strip()
+
+def keep_image(width: int, height: int) -> bool:
+    """Drop icons, bullets and rules that carry nothing worth embedding."""
+    if min(width, height) < IMAGE_MIN_SIDE:
+        return False
+    return max(width, height) / max(min(width, height), 1) <= IMAGE_MAX_ASPECT_RATIO
+
+def extract_page_range(pdf_path: str, chatwindow_id: str, document_id: str, start: int, end: int):
+    """Extract and clean pages ``[start, end)``; returns ``(page_texts, image_data, page_count)``.
+
+    Each image xref is extracted once per range, with every page it appears on listed
+    in ``pages``. Image bytes are returned in memory together with their sha256, and
+    ``image_path`` is where ingestion writes them once the image is known to be new.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_texts = []
+        image_data = []
+        images_by_xref = {}
+        end = min(end, doc.page_count)
+        for page_num in range(start, end):
+            page = doc[page_num]
+            page_texts.append((page_num + 1, clean_text(page.get_text("text"))))
+
+            for img in page.get_images(full=True):
+                xref, width, height = img[0], img[2], img[3]
+                if xref in images_by_xref:
+                    record = images_by_xref[xref]
+                    if record is not None and record["pages"][-1] != page_num + 1:
+                        record["pages"].append(page_num + 1)
+                    continue
+                if not keep_image(width, height):
+                    images_by_xref[xref] = None
+                    continue
+                base_image = doc.extract_image(xref)
+                image_bytes = base_image["image"]
+                content_hash = hashlib.sha256(image_bytes).hexdigest()
+                image_name = f"{chatwindow_id}_{document_id}_{content_hash[:16]}.{base_image['ext']}"
+                record = {
+                    "image_path": os.path.join("saved_images", image_name),
+                    "image_bytes": image_bytes,
+                    "content_hash": content_hash,
+                    "page_number": page_num + 1,
+                    "pages": [page_num + 1],
+                    "metadata": {"xref": xref, "width": base_image["width"], "height": base_image["height"]}
+                }
+                images_by_xref[xref] = record
+                image_data.append(record)
+        return page_texts, image_data, doc.page_count
+
+def get_process_pool(workers: int = EXTRACT_WORKERS):
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+def extract_parallel(pdf_path: str, chatwindow_id: str, document_id: str, page_count: int, workers: int,
+                     pages_per_task: int = EXTRACT_PAGES_PER_TASK):
+    """Split the page range across a process pool and merge the results in page order."""
+    pool = get_process_pool(workers) if workers == EXTRACT_WORKERS else ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = {
+            pool.submit(extract_page_range, pdf_path, chatwindow_id, document_id, start, start + pages_per_task): start
+            for start in range(0, page_count, pages_per_task)
+        }
+        results = {}
+        for future in as_completed(futures):
+            page_texts, image_data, _ = future.result()
+            results[futures[future]] = (page_texts, image_data)
+    finally:
+        if pool is not _process_pool:
+            pool.shutdown()
+
+    page_texts = []
+    image_data = []
+    for start in sorted(results):
+        page_texts.extend(results[start][0])
+        image_data.extend(results[start][1])
+    return page_texts, image_data
+
+def extract_document(pdf_path: str, chatwindow_id: str, document_id: str, workers: int = EXTRACT_WORKERS):
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    if workers > 1 and page_count >= EXTRACT_PARALLEL_MIN_PAGES:
+        return extract_parallel(pdf_path, chatwindow_id, document_id, page_count, workers)
+    page_texts, image_data, _ = extract_page_range(pdf_path, chatwindow_id, document_id, 0, page_count)
+    return page_texts, image_data
+
+async def iter_page_batches(pdf_path: str, chatwindow_id: str, document_id: str, workers: int = EXTRACT_WORKERS,
+                            pages_per_task: int = EXTRACT_PAGES_PER_TASK):
+    """Yield ``(page_texts, image_data, page_count)`` for consecutive page ranges, in page order.
+
+    Only one range per worker is extracted ahead of the consumer, so memory is bounded
+    by ``pages_per_task`` rather than by the size of the document.
+    """
     loop = asyncio.get_event_loop()
-    os.makedirs("saved_images", exist_ok=True)
-
-    def extract_page_texts_and_images():
-        with fitz.open(pdf_path) as doc:
-            page_texts = []
-            image_data = []
-            for page_num, page in enumerate(doc):
-                text = page.get_text("text")
-                page_texts.append(text)
-                
-                for img_index, img in enumerate(page.get_images(full=True)):
-                    xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    image_ext = base_image["ext"]
-                    image_name = f"{chatwindow_id}_{document_id}_page{page_num + 1}_img{img_index}.{image_ext}"
-                    image_path = os.path.join("saved_images", image_name)
-                    with open(image_path, "wb") as f:
-                        f.write(image_bytes)
-                    image_data.append({
-                        "image_path": image_path,
-                        "page_number": page_num + 1,
-                        "metadata": {"xref": xref, "width": base_image["width"], "height": base_image["height"]}
-                    })
-            return page_texts, image_data
-
-    page_texts, image_data = await loop.run_in_executor(None, extract_page_texts_and_images)
-
-    def clean_text(text):
-        cleaned = re.sub(r'\{[^{}]*\}|\<[^\<>]*\>', ' ', text)
-        cleaned = re.sub(r'```[\s\S]*?```', ' ', cleaned)
-        cleaned = re.sub(r'`[^`]*`', ' ', cleaned)
-        cleaned = re.sub(r'\b\d+\.\d+\.\d+[\w.-]*\b', ' ', cleaned)
-        cleaned = re.sub(r'(\.?/)?[\w/-]+/[\w/-]+(\.[\w]+)?', ' ', cleaned)
-        cleaned = re.sub(r'[^\w\s.,!?]', ' ', cleaned)
-        cleaned = re.sub(r'[.,!?]{2,}', ' ', cleaned)
-        cleaned = re.sub(r'[ \t]+', ' ', cleaned)
-        cleaned = re.sub(r'(\n\s*)+\n', '\n\n', cleaned)
-        return cleaned.strip()
-
-    cleaned_page_texts = [(page_num + 1, clean_text(text)) for page_num, text in enumerate(page_texts)]
-    return cleaned_page_texts, image_data
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    parallel = workers > 1 and page_count >= EXTRACT_PARALLEL_MIN_PAGES
+    executor = get_process_pool(workers) if parallel else None
+    starts = iter(range(0, page_count, pages_per_task))
+    pending = collections.deque()
 
-def split_text_into_chunks(paragraphs_with_pages: list[tuple[int, str]], max_words: int = 400, overlap_words: int = 100) -> list[tuple[str, int]]:
-    chunks = []
-    current_chunk = []
-    current_word_count = 0
-    current_page = None
+    def submit_next():
+        start = next(starts, None)
+        if start is not None:
+            pending.append(loop.run_in_executor(
+                executor, extract_page_range, pdf_path, chatwindow_id, document_id, start, start + pages_per_task
+            ))
 
-    for page_num, paragraph in paragraphs_with_pages:
+    for _ in range(workers if parallel else 1):
+        submit_next()
+    try:
+        while pending:
+            page_texts, image_data, _ = await pending.popleft()
+            submit_next()
+            yield page_texts, image_data, page_count
+    finally:
+        for future in pending:
+            future.cancel()
+
+class TextChunker:
+    """Incremental form of ``split_text_into_chunks``: feed paragraphs, collect finished chunks."""
+
+    def __init__(self, max_words: int = 400, overlap_words: int = 100):
+        self.max_words = max_words
+        self.overlap_words = overlap_words
+        self.current_chunk = []
+        self.current_word_count = 0
+        self.current_page = None
+
+    def add(self, page_num: int, paragraph: str) -> list[tuple[str, int]]:
         words = paragraph.split()
         if not words:
-            continue
+            return []
 
-        if current_page is None:
-            current_page = page_num
+        if self.current_page is None:
+            self.current_page = page_num
 
-        if current_word_count + len(words) <= max_words:
-            current_chunk.extend(words)
-            current_word_count += len(words)
+        chunks = []
+        if self.current_word_count + len(words) <= self.max_words:
+            self.current_chunk.extend(words)
+            self.current_word_count += len(words)
         else:
-            if current_chunk:
-                chunk_text = ' '.join(current_chunk)
-                chunks.append((chunk_text, current_page))
-
-            if overlap_words > 0:
-                overlap = current_chunk[-overlap_words:] if len(current_chunk) >= overlap_words else current_chunk
-                current_chunk = list(overlap)
-                current_word_count = len(current_chunk)
+            if self.current_chunk:
+                chunks.append((' '.join(self.current_chunk), self.current_page))
+
+            if self.overlap_words > 0:
+                overlap = self.current_chunk[-self.overlap_words:] if len(self.current_chunk) >= self.overlap_words else self.current_chunk
+                self.current_chunk = list(overlap)
+                self.current_word_count = len(self.current_chunk)
             else:
-                current_chunk = []
-                current_word_count = 0
-
-            current_page = page_num
-            current_chunk.extend(words)
-            current_word_count += len(words)
-
-    if current_chunk:
-        chunk_text = ' '.join(current_chunk)
-        chunks.append((chunk_text, current_page))
-    
-    return chunks
\ No newline at end of file
+                self.current_chunk = []
+                self.current_word_count = 0
+
+            self.current_page = page_num
+            self.current_chunk.extend(words)
+            self.current_word_count += len(words)
+        return chunks
+
+    def flush(self) -> list[tuple[str, int]]:
+        chunks = []
+        if self.current_chunk:
+            chunks.append((' '.join(self.current_chunk), self.current_page))
+        self.current_chunk = []
+        self.current_word_count = 0
+        self.current_page = None
+        return chunks
+
+class TokenChunker:
+    """Chunker with the same interface as ``TextChunker`` that measures chunks in model tokens.
+
+    Chunks end on word boundaries and hold at most ``max_tokens`` tokens of ``tokenizer``,
+    so nothing is cut off when the chunk is embedded; consecutive chunks share about
+    ``overlap_tokens`` tokens. Tokens are counted per word, since the SentencePiece
+    tokenizers of SigLIP-style models never merge across whitespace; counts are
+    cached and new words are tokenized in one batch per paragraph, which keeps slow
+    tokenizers fast on real documents where most words repeat.
+    """
+
+    def __init__(self, tokenizer, max_tokens: int, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        if overlap_tokens >= max_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) must be smaller than max_tokens ({max_tokens})")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self._token_counts = {}
+        self.current_chunk = []
+        self.current_token_count = 0
+        self.current_page = None
+        # False while the chunk holds nothing but the overlap carried over from the last one.
+        self.fresh = False
+
+    def _count_tokens(self, words: list[str]) -> list[int]:
+        new_words = list({word for word in words if word not in self._token_counts})
+        if new_words:
+            token_ids = self.tokenizer(new_words, add_special_tokens=False).input_ids
+            self._token_counts.update((word, len(ids)) for word, ids in zip(new_words, token_ids))
+        return [self._token_counts[word] for word in words]
+
+    def _emit(self, chunks: list, next_page: int):
+        chunks.append((' '.join(word for word, _ in self.current_chunk), self.current_page))
+        overlap = []
+        overlap_count = 0
+        for word, count in reversed(self.current_chunk):
+            if overlap_count + count > self.overlap_tokens:
+                break
+            overlap.append((word, count))
+            overlap_count += count
+        self.current_chunk = overlap[::-1]
+        self.current_token_count = overlap_count
+        self.current_page = next_page
+        self.fresh = False
+
+    def add(self, page_num: int, paragraph: str) -> list[tuple[str, int]]:
+        words = paragraph.split()
+        if not words:
+            return []
+
+        if self.current_page is None:
+            self.current_page = page_num
+
+        chunks = []
+        for word, count in zip(words, self._count_tokens(words)):
+            if self.current_token_count + count > self.max_tokens:
+                if self.fresh:
+                    self._emit(chunks, page_num)
+                # A long word may not fit next to the whole overlap; give up overlap first.
+                while self.current_chunk and self.current_token_count + count > self.max_tokens:
+                    self.current_token_count -= self.current_chunk.pop(0)[1]
+            self.current_chunk.append((word, count))
+            self.current_token_count += count
+            self.fresh = True
+        return chunks
+
+    def flush(self) -> list[tuple[str, int]]:
+        chunks = []
+        if self.fresh:
+            chunks.append((' '.join(word for word, _ in self.current_chunk), self.current_page))
+        self.current_chunk = []
+        self.current_token_count = 0
+        self.current_page = None
+        self.fresh = False
+        return chunks
+
+def text_window(tokenizer) -> int:
+    """Tokens of text the model embeds per input: its max length minus the special tokens it adds."""
+    max_length = tokenizer.model_max_length if tokenizer.model_max_length < 100000 else 64
+    return max_length - tokenizer.num_special_tokens_to_add()
+
+def create_chunker(tokenizer=None):
+    if CHUNKER == "tokens" and tokenizer is not None:
+        return TokenChunker(tokenizer, CHUNK_MAX_TOKENS or text_window(tokenizer), CHUNK_OVERLAP_TOKENS)
+    return TextChunker(max_words=400, overlap_words=100)
+
+def split_text_into_chunks(paragraphs_with_pages: list[tuple[int, str]], max_words: int = 400, overlap_words: int = 100) -> list[tuple[str, int]]:
+    chunker = TextChunker(max_words, overlap_words)
+    chunks = []
+    for page_num, paragraph in paragraphs_with_pages:
+        chunks.extend(chunker.add(page_num, paragraph))
+    chunks.extend(chunker.flush())
+    return chunks
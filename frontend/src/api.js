@@ -71,13 +71,31 @@ export const uploadFile = async (chatwindow_uuid, file) => {
         'Content-Type': 'multipart/form-data',
       },
     });
-    return response.data;
+    return await waitForUpload(response.data.job_id);
   } catch (error) {
     console.error('Error uploading file:', error);
     throw error;
   }
 };
 
+export const fetchUploadStatus = async (job_id) => {
+  const response = await API.get(`/upload/status/${job_id}`);
+  return response.data;
+};
+
+const waitForUpload = async (job_id, intervalMs = 1000) => {
+  while (true) {
+    const job = await fetchUploadStatus(job_id);
+    if (job.status === 'completed') {
+      return job.result;
+    }
+    if (job.status === 'failed') {
+      throw new Error(job.error);
+    }
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+};
+
 export const searchDocuments = async (query, chatwindow_uuid, images = true) => {
   try {
     const response = await API.post('/search', {